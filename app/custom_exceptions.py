@@ -3,3 +3,8 @@
 ######################################################################
 class DataValidationError(ValueError):
     pass
+
+
+class VersionConflictError(Exception):
+    """ Raised when a Product is not stored at the version an update expects """
+    pass
@@ -6,7 +6,7 @@ Handles all of the HTTP Error Codes as JSON
 
 from flask import jsonify, make_response
 from app.server import app
-from app.custom_exceptions import DataValidationError
+from app.custom_exceptions import DataValidationError, VersionConflictError
 
 ######################################################################
 # Error Handlers
@@ -43,6 +43,20 @@ def method_not_supported(error):
     return make_response(jsonify(status=405, error='Method not Allowed', message=message), 405)
 
 
+@app.errorhandler(VersionConflictError)
+def version_conflict_error(error):
+    """ Handles updates of Products that were changed in the meantime """
+    return precondition_failed(error)
+
+
+@app.errorhandler(412)
+def precondition_failed(error):
+    """ Handles failed If-Match preconditions with 412_PRECONDITION_FAILED """
+    message = error.message or str(error)
+    app.logger.info(message)
+    return make_response(jsonify(status=412, error='Precondition Failed', message=message), 412)
+
+
 @app.errorhandler(500)
 def internal_server_error(error):
     """ Handles unexpected server error with 500_SERVER_ERROR """
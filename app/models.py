@@ -9,92 +9,1218 @@ Review  - A review used in product store
 """
 
 import os
-import re
 import json
 import logging
+import time
+import uuid
+import itertools
+import threading
 import pickle
-from cerberus import Validator
-from redis import Redis
-from redis.exceptions import ConnectionError
-from custom_exceptions import DataValidationError
+from collections import OrderedDict
+from redis import Redis, BlockingConnectionPool, ConnectionPool
+from redis.exceptions import ConnectionError, WatchError
+from custom_exceptions import DataValidationError, VersionConflictError
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, JSON is used without it
+    msgpack = None
+
+# numpy is optional and only imported by Catalog.use_snapshot, searches
+# are answered from Redis without it
+numpy = None
 
 logger = logging.getLogger(__name__)
 
+# stream every change to the catalog is appended to, see Catalog.changes
+CHANGES_STREAM = 'catalog:changes'
+CHANGE_KEYS = ['catalog:epoch', 'catalog:version', 'catalog:modified', CHANGES_STREAM]
+
+# Bumps the catalog version, publishes the changed product ids with it
+# and appends the change events to the change stream
+# keys: epoch, version, modified time, change stream
+# args: new epoch, time, channel, instance, changed ids or '*',
+#       about how many events the stream keeps
+# events: op, product id, product version and changed fields of each
+#         change, from index first on
+CHANGE_FUNCTION = """
+local function change(keys, args, events, first)
+    redis.call('SETNX', keys[1], args[1])
+    local version = redis.call('INCR', keys[2])
+    redis.call('SET', keys[3], args[2])
+    redis.call('PUBLISH', args[3], args[4] .. ':' .. version .. ':' .. args[5])
+    local catalog_version = redis.call('GET', keys[1]) .. '-' .. version
+    for i = first, #events, 4 do
+        redis.call('XADD', keys[4], 'MAXLEN', '~', args[6], '*',
+                   'op', events[i], 'id', events[i + 1], 'version', events[i + 2],
+                   'fields', events[i + 3], 'catalog_version', catalog_version)
+    end
+    return version
+end
+"""
+
+# Applies a change made by a pipeline, see CHANGE_FUNCTION
+# KEYS: epoch, version, modified time, change stream
+# ARGV: the args of CHANGE_FUNCTION, then the events
+CHANGE_SCRIPT = CHANGE_FUNCTION + """
+return change(KEYS, ARGV, ARGV, 7)
+"""
+
+# Appends a review and updates the review aggregates, score index and
+# product version, then applies the change, see CHANGE_FUNCTION.
+# Returns 0 if there is no such product and -1 if it isn't stored at one
+# of the expected versions. A product without a version of its own is
+# at the catalog version
+# KEYS: product hash, legacy product, review list, count hash,
+#       score sum hash, review index, then the keys of CHANGE_FUNCTION
+# ARGV: product id, encoded review, review score, new version, the args
+#       of CHANGE_FUNCTION but the changed ids, expected versions if any
+ADD_REVIEW_SCRIPT = CHANGE_FUNCTION + """
+if redis.call('EXISTS', KEYS[1], KEYS[2]) == 0 then
+    return 0
+end
+if #ARGV > 9 then
+    local current = redis.call('HGET', KEYS[1], 'version')
+    if not current then
+        current = (redis.call('GET', KEYS[7]) or '') .. '-' .. (redis.call('GET', KEYS[8]) or '0')
+    end
+    local matched = false
+    for i = 10, #ARGV do
+        if ARGV[i] == current then
+            matched = true
+        end
+    end
+    if not matched then
+        return -1
+    end
+end
+redis.call('RPUSH', KEYS[3], ARGV[2])
+local count = redis.call('HINCRBY', KEYS[4], ARGV[1], 1)
+local total = redis.call('HINCRBY', KEYS[5], ARGV[1], ARGV[3])
+redis.call('ZADD', KEYS[6], total / count, ARGV[1])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HSET', KEYS[1], 'version', ARGV[4])
+end
+change({KEYS[7], KEYS[8], KEYS[9], KEYS[10]},
+       {ARGV[5], ARGV[6], ARGV[7], ARGV[8], ARGV[1], ARGV[9]},
+       {'review', ARGV[1], ARGV[4], 'review_list'}, 1)
+return count
+"""
+
+# Reads Products for an update in one call, on a connection that is
+# watching them
+# KEYS: product hash and legacy product of each Product
+READ_SCRIPT = """
+local result = {}
+for i = 1, #KEYS, 2 do
+    result[#result + 1] = redis.call('HGETALL', KEYS[i])
+    result[#result + 1] = redis.call('GET', KEYS[i + 1])
+end
+return result
+"""
+
+# Replaces a list item only if it wasn't changed since it was read
+# KEYS: list key  ARGV: item index, item read, new item
+REPLACE_ITEM_SCRIPT = """
+if redis.call('LINDEX', KEYS[1], ARGV[1]) == ARGV[2] then
+    redis.call('LSET', KEYS[1], ARGV[1], ARGV[3])
+    return 1
+end
+return 0
+"""
+
+######################################################################
+#  S T O R A G E   C O D E C S
+######################################################################
+# Every stored value starts with the format version and the tag of the
+# codec it was encoded with. Values without it were stored with pickle.
+FORMAT_VERSION = b'\x01'
+
+
+class JsonCodec(object):
+    """ Encodes stored values as compact JSON """
+    tag = b'j'
+
+    def encode(self, data):
+        """ Encodes a dictionary """
+        return json.dumps(data, separators=(',', ':'))
+
+    def decode(self, value):
+        """ Decodes a dictionary """
+        return json.loads(value)
+
+
+class MsgpackCodec(object):
+    """ Encodes stored values as MessagePack, a compact binary format """
+    tag = b'm'
+
+    def encode(self, data):
+        """ Encodes a dictionary """
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, value):
+        """ Decodes a dictionary """
+        return msgpack.unpackb(value, raw=False)
+
+
+# The scalar fields of a Product, stored as the fields of a Redis hash
+PRODUCT_FIELDS = ['id', 'name', 'price', 'image_id', 'description']
+INTEGER_FIELDS = ['id', 'price']
+# The rules Products received from clients are validated with
+PRODUCT_SCHEMA = {
+    'id': {'type': 'integer'},
+    'name': {'type': 'string', 'required': True},
+    'price': {'type': 'integer', 'required': True},
+    'image_id': {'type': 'string'},
+    'description': {'type': 'string'},
+    'review_list': {'type': 'list'}
+}
+
+CODECS = {'json': JsonCodec()}
+if msgpack:
+    CODECS['msgpack'] = MsgpackCodec()
+CODEC_TAGS = dict((codec.tag, codec) for codec in CODECS.values())
+
+
+class SchemaValidator(object):
+    """
+    Validates documents against a Cerberus style schema of type and required
+    rules. The schema is compiled once into the types allowed for each field
+    and validation keeps no state, so one instance can be shared by threads
+    """
+    TYPES = {
+        'integer': (int, long),
+        'string': basestring,
+        'list': (list, tuple),
+        'dict': dict
+    }
+
+    def __init__(self, schema):
+        self.types = {}
+        self.required = []
+        for field, rules in schema.items():
+            for rule in rules:
+                if rule not in ['type', 'required']:
+                    raise ValueError('Unsupported rule {0} of field {1}'.format(rule, field))
+            self.types[field] = self.TYPES[rules['type']]
+            if rules.get('required'):
+                self.required.append(field)
+
+    def validate(self, document):
+        """ Returns whether the document is a dictionary that follows the schema """
+        if not isinstance(document, dict):
+            return False
+        for field in self.required:
+            if field not in document:
+                return False
+        for field, value in document.items():
+            types = self.types.get(field)
+            if types is None or not isinstance(value, types):
+                return False
+        return True
+
+# Channel the ids of changed Products are published on with the catalog
+# version, as '<instance>:<version>:<id>,<id>' or '<instance>:<version>:*'
+INVALIDATE_CHANNEL = 'catalog:invalidate'
+
+
+class LRUCache(object):
+    """
+    A thread safe LRU cache whose entries expire after ttl seconds, used for
+    the stored data of Products by id and for rendered responses. With
+    max_bytes, the entries are also kept under that many bytes in total
+    """
+
+    def __init__(self, size, ttl, max_bytes=None):
+        self.size = size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # bumped by every drop, so data read before a drop isn't cached
+        self.generation = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        """ Returns the cached value of a key or None """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self.bytes -= entry[2]
+                self.misses += 1
+                return None
+            # the most recently used entries are kept last
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, generation, size=0):
+        """
+        Caches the value of a key read at the given generation, replacing
+        the value it had. size is the bytes the value counts for
+        """
+        with self.lock:
+            if generation != self.generation:
+                return
+            self._pop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self.entries[key] = (time.time() + self.ttl, value, size)
+            self.bytes += size
+            while len(self.entries) > self.size or (
+                    self.max_bytes is not None and self.bytes > self.max_bytes):
+                self.bytes -= self.entries.popitem(last=False)[1][2]
+                self.evictions += 1
+
+    def drop(self, keys=None):
+        """ Drops the given keys from the cache, or all of them """
+        with self.lock:
+            self.generation += 1
+            if keys is None:
+                self.entries.clear()
+                self.bytes = 0
+            for key in keys or []:
+                self._pop(key)
+
+    def _pop(self, key):
+        """ Removes a key, the lock must be held """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def stats(self):
+        """ Returns the size and the hit, miss and eviction counters """
+        with self.lock:
+            return {'size': len(self.entries), 'max_size': self.size, 'bytes': self.bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
 
 class Catalog:
-    def __init__(self, redis=None):
+    # sorted index and whether it is read highest first for each sort order
+    SORTS = {
+        'price': ('index:price', False),
+        'price-': ('index:price', True),
+        'name': ('index:sort:name', False),
+        'name-': ('index:sort:name', True),
+        'review': ('index:sort:review', True)
+    }
+    # stored field each sort order compares, the review order uses aggregates
+    SORT_FIELDS = {'price': 'price', 'price-': 'price', 'name': 'name', 'name-': 'name'}
+
+    def __init__(self, redis=None, chunk_size=500, codec='msgpack' if msgpack else 'json'):
         """Redis handles storage as well as index, thread safety"""
-        # Define the rules and validator according the rules.
-        schema = {
-            'id': {'type': 'integer'},
-            'name': {'type': 'string', 'required': True},
-            'price': {'type': 'integer', 'required': True},
-            'image_id':{'type': 'string'},
-            'description': {'type': 'string'},
-            'review_list': {'type': 'list'}
-        }
-        self.validator = Validator(schema)
+        # Define the validator according the rules.
+        self.validator = SchemaValidator(PRODUCT_SCHEMA)
         self.redis = redis
+        # number of products fetched per MGET round trip
+        self.chunk_size = chunk_size
+        # about how many events the change stream keeps
+        self.changes_maxlen = 10000
+        # keyword arguments of the BlockingConnectionPool of connect_to_redis
+        self.pool_options = {}
+        # in-process cache in front of find, see use_cache
+        self.cache = None
+        # columnar copy of the catalog for filtered searches, see use_snapshot
+        self.snapshot = None
+        self.listener = None
+        # tells the invalidations of this instance from those of the others
+        self.instance = uuid.uuid4().hex
+        self.codec = None
+        self.use_codec(codec)
+
+    def use_codec(self, name):
+        """
+        Selects the codec that Products and Reviews are stored with
+        Values stored with other codecs are still read
+        Exception:
+        ----------
+          ValueError - if the codec is unknown or its package isn't installed
+        """
+        if name not in CODECS:
+            raise ValueError('Unknown or unavailable codec: ' + name)
+        self.codec = CODECS[name]
 
     def next_index(self):
         """ Increments the index and returns it """
         return self.redis.incr('index')
 
-    def save(self, product):
+    def save(self, product, versions=None):
         """
         Saves a Product to the data store
         This includes save a new Product or Update a product with the same id
+        Args:
+            versions (list): the versions the Product may be stored at for
+                the save to go ahead, any version by default
+        Exception:
+        ----------
+          VersionConflictError - if the Product is stored at another version
         """
-        if product.name is None:
-            raise DataValidationError('name attribute is not set and it is required')
-        if product.id <= 0:
-            product.set_id(self.next_index())
+        self.save_many([product], None if versions is None else [versions])
 
-        self.redis.set(product.id, pickle.dumps(product.serialize()))
+    def save_many(self, products, versions=None):
+        """
+        Saves many Products to the data store in a single transaction
+        The ids of the new Products are allocated with a single INCRBY.
+        The stored Products are read and written under WATCH, so the
+        transaction is retried if another client changes one of them
+        in between, and each Product is given a new version
+        Args:
+            products (list): the Products to save
+            versions (list): for each Product, the versions it may be stored
+                at for the save to go ahead, or None for any version
+        Exception:
+        ----------
+          VersionConflictError - if a Product is stored at another version
+        """
+        for product in products:
+            if product.name is None:
+                raise DataValidationError('name attribute is not set and it is required')
+        new = [product for product in products if product.id <= 0]
+        if new:
+            last = self.redis.incrby('index', len(new))
+            for offset, product in enumerate(new):
+                product.set_id(last - len(new) + 1 + offset)
+        versions = versions or [None] * len(products)
+
+        # the ids just allocated can't be stored yet, only updates are read
+        new_ids = set(product.id for product in new)
+        updated = [product.id for product in products if product.id not in new_ids]
+        keys = [key for id in updated for key in [self._key(id), id]]
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    if keys:
+                        pipe.watch(*keys)
+                    # read on the watched connection, a save holds only one
+                    read = dict(zip(updated, self._read_many(updated, pipe)))
+                    stored = [read.get(product.id, (None, False)) for product in products]
+                    for product, (old, _), allowed in zip(products, stored, versions):
+                        if allowed is None:
+                            continue
+                        current = old.get('version') if old else None
+                        # Products stored before they had versions are
+                        # tagged with the catalog version, see product_version
+                        if old is not None and current is None:
+                            current = self.version(pipe)[0]
+                        if current not in allowed:
+                            raise VersionConflictError(
+                                "Product with id '{0}' was changed by another request".format(product.id))
+                    pipe.multi()
+                    written = {}
+                    events = OrderedDict()
+                    for product, (old, stored_as_hash) in zip(products, stored):
+                        # a Product saved twice in a batch is written over its first write
+                        if product.id in written:
+                            old, stored_as_hash = written[product.id], True
+                        op = 'create' if old is None else 'update'
+                        written[product.id] = self._write(pipe, product, old, stored_as_hash)
+                        fields = self._changed_fields(product, old, written[product.id])
+                        if product.id in events:
+                            op = events[product.id][0]
+                            fields = [field for field in PRODUCT_FIELDS + ['review_list']
+                                      if field in fields or field in events[product.id][3]]
+                        events[product.id] = (op, product.id, written[product.id]['version'], fields)
+                    self._execute(pipe, written.keys(), events.values())
+                    break
+                except WatchError:
+                    continue
+        for product in products:
+            product.version = written[product.id]['version']
+
+    def _write(self, pipe, product, old, stored_as_hash):
+        """
+        Writes a Product over its previously stored data in a pipeline
+        Returns the data written, with the new version of the Product
+        """
+        data = product.serialize(PRODUCT_FIELDS)
+        # only the fields that changed are written to an existing hash
+        if stored_as_hash:
+            fields = dict((field, value) for field, value in data.items()
+                          if old.get(field) != value)
+        else:
+            fields = data
+        if fields:
+            pipe.hset(self._key(product.id), mapping=fields)
+        if old is not None and not stored_as_hash:
+            pipe.delete(product.id)
+        self._update_index(pipe, old, data)
+        # reviews that were never loaded are left as they are
+        if product.review_list is not None:
+            self._write_reviews(pipe, product)
+        data['version'] = new_version()
+        pipe.hset(self._key(product.id), 'version', data['version'])
+        return data
+
+    @staticmethod
+    def _changed_fields(product, old, data):
+        """ Returns the names of the fields a write changed """
+        fields = [field for field in PRODUCT_FIELDS
+                  if old is None or old.get(field) != data.get(field)]
+        if product.review_list is not None:
+            fields.append('review_list')
+        return fields
+
+    def ids(self, cursor=None, limit=None):
+        """
+        Returns the ids of the Products in the database in id order
+        Args:
+            cursor (int): only return ids greater than the cursor
+            limit (int): return at most limit ids
+        """
+        low = '-inf' if cursor is None else '({0}'.format(cursor)
+        if limit is None:
+            ids = self.redis.zrangebyscore('products', low, '+inf')
+        else:
+            ids = self.redis.zrangebyscore('products', low, '+inf', start=0, num=limit)
+        return [int(id) for id in ids]
+
+    def iter_chunks(self, fields=None):
+        """
+        Yields every Product in id order, in lists of at most chunk_size
+        Products, so that only one chunk is held in memory at a time
+        Args:
+            fields (list): only fetch and set these stored fields
+        """
+        cursor = None
+        while True:
+            ids = self.ids(cursor, self.chunk_size)
+            if not ids:
+                return
+            yield self.find_many(ids, fields)
+            cursor = ids[-1]
+
+    def fetch(self, ids, fields=None):
+        """
+        Fetches the stored data of many Products with chunked, pipelined
+        HMGET calls
+        Yields one dictionary per Product in the order of ids, skipping ids
+        that are no longer in the database. The review aggregates are
+        fetched in the same round trip and added to each dictionary
+        Args:
+            ids (list): the ids of the Products
+            fields (list): the fields to fetch, all of them by default
+        """
+        fields = list(PRODUCT_FIELDS if fields is None else fields)
+        if 'id' not in fields:
+            fields.insert(0, 'id')
+        for start in range(0, len(ids), self.chunk_size):
+            chunk = ids[start:start + self.chunk_size]
+            pipe = self.redis.pipeline(transaction=False)
+            for id in chunk:
+                pipe.hmget(self._key(id), fields)
+            pipe.hmget('reviews:count', chunk)
+            pipe.hmget('reviews:score_sum', chunk)
+            results = pipe.execute()
+            totals, counts = results.pop(), results.pop()
+            # products stored before hashes were used are still read
+            legacy = [id for id, values in zip(chunk, results)
+                      if values[fields.index('id')] is None]
+            blobs = {}
+            if legacy:
+                pipe = self.redis.pipeline(transaction=False)
+                for id in legacy:
+                    pipe.get(id)
+                    pipe.lrange('reviews:{0}'.format(id), 0, -1)
+                values = pipe.execute()
+                blobs = dict(zip(legacy, zip(values[::2], values[1::2])))
+            for id, values, count, total in zip(chunk, results, counts, totals):
+                if values[fields.index('id')] is not None:
+                    data = self._from_hash(fields, values)
+                elif blobs.get(id, (None,))[0] is not None:
+                    blob, listed = blobs[id]
+                    data = self._decode(blob)
+                    data = dict((field, data[field]) for field in data
+                                if field in fields or field == 'review_list')
+                    # reviews added to the list come after the inline ones
+                    if 'review_list' in data and listed:
+                        data['review_list'] = list(data['review_list']) + \
+                            [self._decode(review) for review in listed]
+                else:
+                    continue
+                # products saved before reviews were stored on their own
+                # still carry their review_list
+                if 'review_list' not in data:
+                    data['review_count'] = int(count or 0)
+                    data['review_score_sum'] = int(total or 0)
+                yield data
+
+    def find_many(self, ids, fields=None):
+        """
+        Find many Products by their IDs with bulk fetches
+        Only the given stored fields are fetched and set, if any
+        """
+        return [self._load(data) for data in self.fetch(ids, fields)]
 
     def all(self):
         """ Returns all of the Products in the database """
         # return a `copy` of data
-        results = []
-        for key in self.redis.keys():
-            if key != 'index':  # filter out our id index
-                data = pickle.loads(self.redis.get(key))
-                product = Product(id=data['id']).deserialize(data)
-                results.append(product)
-        return results
-
-    def find(self, id):
-        """ Find a Product by its ID """
-        if self.redis.exists(id):
-            data = pickle.loads(self.redis.get(id))
-            product = Product(id=data['id']).deserialize(data)
-            return product
+        return self.find_many(self.ids())
+
+    def find(self, id, fields=None):
+        """
+        Find a Product by its ID
+        Only the given stored fields are fetched and set, if any
+        """
+        data = self.cache.get(int(id)) if self.cache else None
+        if data is not None:
+            return self._load(data)
+        # only Products with all of their fields are cached
+        generation = self.cache.generation if self.cache else None
+        for data in self.fetch([id], fields):
+            if self.cache and set(PRODUCT_FIELDS) <= set(data):
+                self.cache.put(int(id), data, generation)
+            return self._load(data)
         return None
 
+    def exists(self, id):
+        """ Returns whether a Product with the ID is in the database """
+        return bool(self.redis.exists(self._key(id), id))
+
+    def reviews(self, id, start=0, stop=-1):
+        """
+        Returns the Reviews of a Product from start to stop inclusive
+        The Reviews of Products stored as single values with their Reviews
+        inline come before any that were added since
+        """
+        key = 'reviews:{0}'.format(id)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(id)
+        pipe.lrange(key, start, stop)
+        blob, reviews = pipe.execute()
+        inline = self._decode(blob).get('review_list') if blob is not None else None
+        if not inline:
+            return [Review().deserialize(self._decode(review)) for review in reviews]
+        reviews = inline + [self._decode(review) for review in self.redis.lrange(key, 0, -1)]
+        return [Review().deserialize(review)
+                for review in reviews[start:None if stop == -1 else stop + 1]]
+
+    def load_reviews(self, products):
+        """ Loads the Reviews of many Products with pipelined fetches """
+        for start in range(0, len(products), self.chunk_size):
+            chunk = [product for product in products[start:start + self.chunk_size]
+                     if product.review_list is None]
+            pipe = self.redis.pipeline(transaction=False)
+            for product in chunk:
+                pipe.lrange('reviews:{0}'.format(product.id), 0, -1)
+            for product, reviews in zip(chunk, pipe.execute()):
+                product.review_list = [Review().deserialize(self._decode(review))
+                                       for review in reviews]
+
+    def add_review(self, id, review, versions=None):
+        """
+        Appends a Review to a Product with a single atomic script
+        The review list, the review aggregates and the review score index
+        are updated together without rewriting the Product
+        Returns the updated Product or None if it doesn't exist
+        Args:
+            versions (list): the versions the Product may be stored at for
+                the review to be added, any version by default
+        Exception:
+        ----------
+          VersionConflictError - if the Product is stored at another version
+        """
+        # a Product stored as a single value is moved to a hash first, which
+        # moves the Reviews it holds inline to the list the Review is added to
+        if self.redis.exists(id):
+            for data in self.fetch([id]):
+                product = self._load(data)
+                self.save(product, versions)
+                versions = None if versions is None else [product.version]
+        add = self.redis.register_script(ADD_REVIEW_SCRIPT)
+        keys = [self._key(id), id, 'reviews:{0}'.format(id), 'reviews:count',
+                'reviews:score_sum', 'index:sort:review'] + CHANGE_KEYS
+        version = new_version()
+        args = [id, self._encode(review.serialize()), int(review.get_score()), version]
+        change_args = self._change_args(str(id))
+        args += change_args[:4] + change_args[5:]
+        result = add(keys=keys, args=args + list(versions or []))
+        if result == -1:
+            raise VersionConflictError(
+                "Product with id '{0}' was changed by another request".format(id))
+        if not result:
+            return None
+        if self.cache:
+            self.cache.drop([int(id)])
+        product = self.find(id)
+        if product:
+            product.version = version
+        return product
+
     def delete(self, id):
-        self.redis.delete(id)
+        """ Removes a Product and its index entries from the database """
+        self.delete_many([id])
 
-    def remove_all(self):
-        self.redis.flushall()
+    def delete_many(self, ids):
+        """
+        Removes many Products and their index entries from the database in
+        a single transaction
+        Returns the ids of the Products that were found and removed
+        """
+        deleted = []
+        pipe = self.redis.pipeline()
+        for id, (old, _) in zip(ids, self._read_many(ids)):
+            if old is None or id in deleted:
+                continue
+            pipe.delete(self._key(id), id, 'reviews:{0}'.format(id))
+            pipe.hdel('reviews:count', id)
+            pipe.hdel('reviews:score_sum', id)
+            pipe.zrem('index:sort:review', id)
+            self._update_index(pipe, old, None)
+            deleted.append(id)
+        if deleted:
+            self._execute(pipe, deleted, [('delete', id, '', []) for id in deleted])
+        return deleted
 
     def query(self, keyword, value):
         """ Find Products by keyword """
-        found = []
-        pattern = r'.*?{0}.*?'.format(value) # ignore case
-        for key in self.redis.keys():
-            if key != 'index':  # filter out our id index
-                data = pickle.loads(self.redis.get(key))
-                # logging.info('try to match with: ' + str(data[keyword]))
-                match = re.search(pattern, str(data[keyword]), re.IGNORECASE)
-                if match:
-                    logging.info('so this is a match!')
-                    found.append(Product(id=data['id']).deserialize(data))
-        # logging.info('found {0} matches!'.format(len(found)))
-        return found
+        return self.search({keyword: value})
+
+    def search(self, filters, cursor=None, limit=None, sort=None, fields=None):
+        """
+        Find the Products matching every filter in a single pass
+        id, price, price_min, price_max and image_id are exact or range
+        matches, score_min is a minimum average review score, name and
+        description are case insensitive substring matches. The filter
+        whose index yields the fewest candidates is resolved first, then
+        every candidate is fetched once and checked against all of the
+        filters. Filters the snapshot holds, if it is used, are resolved
+        from it instead. Results are in id order unless a sort order is given
+        Args:
+            filters (dict): the query filters by keyword
+            cursor (int): in id order, only return Products with an id
+                greater than the cursor. In a sort order, skip that many
+                Products
+            limit (int): return at most limit Products
+            sort (str): one of the sort orders in Catalog.SORTS
+            fields (list): only fetch and set these stored fields of the
+                Products, all of them by default
+        Exception:
+        ----------
+          DataValidationError - if a filter is unknown or has a bad value
+        """
+        filters = self._normalize(filters)
+        if fields is not None:
+            # the fields that filters and sorts are checked on are needed too
+            fields = [field for field in PRODUCT_FIELDS
+                      if field in fields or field in filters or field == self.SORT_FIELDS.get(sort)]
+        if filters and self.snapshot:
+            ids = self.snapshot.search(filters, cursor, limit, sort)
+            if ids is not None:
+                return self.find_many(ids, fields)
+        if sort in self.SORTS:
+            return self._sorted(filters, cursor or 0, limit, sort, fields)
+        if not filters:
+            return self.find_many(self.ids(cursor, limit), fields)
+        ids = self._candidates(filters)
+        if cursor is not None:
+            ids = [id for id in ids if id > cursor]
+        # fetch lazily so that a page stops reading once it is full
+        matches = (data for data in self.fetch(ids, fields) if self._matches(data, filters))
+        return [self._load(data) for data in itertools.islice(matches, limit)]
+
+    def _sorted(self, filters, offset, limit, sort, fields):
+        """
+        Returns a page of the Products matching the filters in a sort order
+        Without filters the page is read straight from the sorted index
+        """
+        key, reverse = self.SORTS[sort]
+        if not filters:
+            stop = -1 if limit is None else offset + limit - 1
+            members = self.redis.zrange(key, offset, stop, desc=reverse)
+            if key == 'index:sort:name':
+                members = [member.rsplit(b'\x00', 1)[1] for member in members]
+            return self.find_many([int(member) for member in members], fields)
+
+        products = [self._load(data) for data in self.fetch(self._candidates(filters), fields)
+                    if self._matches(data, filters)]
+        if key == 'index:price':
+            products.sort(key=lambda p: p.get_price(), reverse=reverse)
+        elif key == 'index:sort:name':
+            products.sort(key=lambda p: p.get_name().lower(), reverse=reverse)
+        else:
+            products.sort(key=lambda p: p.avg_score(), reverse=reverse)
+        stop = None if limit is None else offset + limit
+        return products[offset:stop]
+
+    def _normalize(self, filters):
+        """
+        Converts query filters to the values they are matched with
+        price, price_min and price_max are merged into one price range
+        """
+        normalized = {}
+        for keyword, value in filters.items():
+            if keyword == 'id':
+                normalized['id'] = self._integer(keyword, value)
+            elif keyword in ['price', 'price_min', 'price_max']:
+                low, high = normalized.get('price', (float('-inf'), float('inf')))
+                if keyword in ['price', 'price_min']:
+                    low = max(low, self._integer(keyword, value))
+                if keyword in ['price', 'price_max']:
+                    high = min(high, self._integer(keyword, value))
+                normalized['price'] = (low, high)
+            elif keyword == 'image_id':
+                normalized['image_id'] = value
+            elif keyword in ['name', 'description']:
+                normalized[keyword] = value.lower()
+            elif keyword == 'score_min':
+                try:
+                    normalized['score_min'] = float(value)
+                except ValueError:
+                    raise DataValidationError('Invalid query: score_min must be a number')
+            else:
+                raise DataValidationError('Invalid query: unknown attribute ' + keyword)
+        return normalized
+
+    def _candidates(self, filters):
+        """
+        Returns the ids of the candidates of the most selective filter
+        The size of every index lookup is estimated in one round trip and
+        only the smallest one is read
+        """
+        if 'id' in filters:
+            return [filters['id']]
+        keys = {}
+        for keyword, value in filters.items():
+            if keyword in ['name', 'description']:
+                keys[keyword] = [u'index:{0}:{1}'.format(keyword, gram)
+                                 for gram in ngrams(value)]
+            elif keyword == 'image_id':
+                keys[keyword] = ['index:image_id:' + value]
+
+        pipe = self.redis.pipeline(transaction=False)
+        for keyword in filters:
+            if keyword == 'price':
+                pipe.zcount('index:price', *filters['price'])
+            elif keyword == 'score_min':
+                pipe.zcount('index:sort:review', filters['score_min'], '+inf')
+            elif keys[keyword]:
+                for key in keys[keyword]:
+                    pipe.scard(key)
+            else:
+                # too short to have an n-gram, every product is a candidate
+                pipe.zcard('products')
+        counts = iter(pipe.execute())
+        sizes = []
+        for keyword in filters:
+            size = min(next(counts) for _ in range(len(keys.get(keyword, [])) or 1))
+            sizes.append((size, keyword))
+        keyword = min(sizes)[1]
+
+        if keyword == 'price':
+            ids = self.redis.zrangebyscore('index:price', *filters['price'])
+        elif keyword == 'score_min':
+            ids = self.redis.zrangebyscore('index:sort:review', filters['score_min'], '+inf')
+        elif keys[keyword]:
+            ids = self.redis.sinter(keys[keyword])
+        else:
+            return self.ids()
+        return sorted(int(id) for id in ids)
+
+    @staticmethod
+    def _matches(data, filters):
+        """ Checks the stored data of a Product against normalized filters """
+        for keyword, value in filters.items():
+            if keyword == 'price':
+                if not value[0] <= data['price'] <= value[1]:
+                    return False
+            elif keyword in ['name', 'description']:
+                # n-gram matches are only candidates, so check the actual text
+                if value not in data[keyword].lower():
+                    return False
+            elif keyword == 'score_min':
+                reviews = data.get('review_list')
+                if reviews is not None:
+                    count, total = len(reviews), sum(int(review['score']) for review in reviews)
+                else:
+                    count, total = data['review_count'], data['review_score_sum']
+                # as avg_score, a product without reviews scores 0
+                if (float(total) / count if count else 0.0) < value:
+                    return False
+            elif data[keyword] != value:
+                return False
+        return True
+
+    def reindex(self):
+        """
+        Adds the stored products to the product id and secondary indexes
+        Uses SCAN and only ever adds index entries, so that it can be run
+        against a live server to pick up products that were saved before
+        the indexes existed. The catalog version is bumped if there are
+        any, so nothing cached before is served
+        """
+        ids = set()
+        for key in self.redis.scan_iter(count=1000):
+            if key.isdigit():
+                ids.add(int(key))
+            elif key.startswith(b'product:') and key[8:].isdigit():
+                ids.add(int(key[8:]))
+        ids = sorted(ids)
+        for start in range(0, len(ids), self.chunk_size):
+            chunk = ids[start:start + self.chunk_size]
+            indexed = {}
+            pipe = self.redis.pipeline()
+            for data in self.fetch(chunk):
+                self._update_index(pipe, None, data)
+                product = self._load(data)
+                pipe.zadd('index:sort:review', {product.id: product.avg_score()})
+                indexed[data['id']] = data
+            pipe.execute()
+            # a product deleted meanwhile loses the entries added for it
+            pipe = self.redis.pipeline()
+            for id, (old, _) in zip(indexed.keys(), self._read_many(indexed.keys())):
+                if old is None:
+                    self._update_index(pipe, indexed[id], None)
+                    pipe.zrem('index:sort:review', id)
+            pipe.execute()
+        pipe = self.redis.pipeline()
+        pipe.set('catalog:indexed', 1)
+        if ids:
+            self._execute(pipe, None, [('reindex', '', '', [])])
+        else:
+            pipe.execute()
+
+    def _update_index(self, pipe, old, new):
+        """
+        Moves the index entries of a Product from its previously stored
+        data to its new data in a pipeline. old is None for a new Product
+        and new is None for a deleted one
+        """
+        id = (new or old)['id']
+        old = old or {}
+        new = new or {}
+        if new:
+            pipe.zadd('products', {id: id})
+            pipe.zadd('index:price', {id: new['price']})
+        else:
+            pipe.zrem('products', id)
+            pipe.zrem('index:price', id)
+        # names are sorted by member, so the id is appended to keep them unique
+        if old.get('name') != new.get('name'):
+            if old:
+                pipe.zrem('index:sort:name', u'{0}\x00{1}'.format(old['name'].lower(), id))
+            if new:
+                pipe.zadd('index:sort:name', {u'{0}\x00{1}'.format(new['name'].lower(), id): 0})
+        if old.get('image_id') != new.get('image_id'):
+            if old:
+                pipe.srem('index:image_id:' + old['image_id'], id)
+            if new:
+                pipe.sadd('index:image_id:' + new['image_id'], id)
+        # only touch the n-grams that were added or removed by the change
+        for keyword in ['name', 'description']:
+            before = ngrams(old.get(keyword, ''))
+            after = ngrams(new.get(keyword, ''))
+            for gram in before - after:
+                pipe.srem(u'index:{0}:{1}'.format(keyword, gram), id)
+            for gram in after - before:
+                pipe.sadd(u'index:{0}:{1}'.format(keyword, gram), id)
+
+    def _write_reviews(self, pipe, product):
+        """ Replaces the stored Reviews of a Product in a pipeline """
+        key = 'reviews:{0}'.format(product.id)
+        pipe.delete(key)
+        if product.review_list:
+            pipe.rpush(key, *[self._encode(review.serialize()) for review in product.review_list])
+        pipe.hset('reviews:count', product.id, product.review_count)
+        pipe.hset('reviews:score_sum', product.id, product.review_score_sum)
+        pipe.zadd('index:sort:review', {product.id: product.avg_score()})
+
+    def _read(self, id):
+        """
+        Reads the stored data of a Product for an update
+        Returns the data, or None if there is no such Product, and whether
+        the Product is stored as a hash
+        """
+        return self._read_many([id])[0]
+
+    def _read_many(self, ids, client=None):
+        """
+        Reads the stored data of many Products like _read, in one round trip,
+        on client if it is given, a pipeline that is watching them
+        """
+        if not ids:
+            return []
+        if client is None:
+            pipe = self.redis.pipeline(transaction=False)
+            for id in ids:
+                pipe.hgetall(self._key(id))
+                pipe.get(id)
+            results = pipe.execute()
+        else:
+            # a script runs at once on a watching pipeline, in one round trip
+            read = self.redis.register_script(READ_SCRIPT)
+            results = read(keys=[key for id in ids for key in [self._key(id), id]], client=client)
+            results[::2] = [dict(zip(values[::2], values[1::2])) for values in results[::2]]
+        stored = []
+        for values, blob in zip(results[::2], results[1::2]):
+            if values:
+                fields = [field.decode('utf-8') for field in values]
+                stored.append((self._from_hash(fields, list(values.values())), True))
+            elif blob is not None:
+                stored.append((self._decode(blob), False))
+            else:
+                stored.append((None, False))
+        return stored
+
+    @staticmethod
+    def _key(id):
+        """ Returns the key of the hash a Product is stored in """
+        return 'product:{0}'.format(id)
+
+    @staticmethod
+    def _from_hash(fields, values):
+        """ Converts the values read from a Product hash to a dictionary """
+        data = {}
+        for field, value in zip(fields, values):
+            if value is not None:
+                if field in INTEGER_FIELDS:
+                    data[field] = int(value)
+                else:
+                    data[field] = value.decode('utf-8')
+        return data
+
+    def _encode(self, data):
+        """ Encodes a dictionary with the current codec and format header """
+        return FORMAT_VERSION + self.codec.tag + self.codec.encode(data)
+
+    @staticmethod
+    def _decode(value):
+        """ Decodes a stored value with the codec named in its header """
+        if value[:1] != FORMAT_VERSION:
+            return pickle.loads(value)
+        codec = CODEC_TAGS.get(value[1:2])
+        if codec is None:
+            raise ValueError('No codec available for stored value tagged ' + repr(value[1:2]))
+        return codec.decode(value[2:])
+
+    @staticmethod
+    def _load(data):
+        """
+        Builds a Product from the stored data yielded by fetch
+        Its reviews are left to be loaded lazily, only the aggregates are set.
+        Data fetched for only some of the fields sets just those fields
+        """
+        data = dict(data)
+        review_count = data.pop('review_count', 0)
+        review_score_sum = data.pop('review_score_sum', 0)
+        # the data was validated when it was saved
+        product = Product(id=data['id']).deserialize(data, validate=False)
+        if 'review_list' not in data:
+            product.review_list = None
+            product.review_count = review_count
+            product.review_score_sum = review_score_sum
+        return product
+
+    @staticmethod
+    def _integer(keyword, value):
+        """ Converts a query value to an integer """
+        try:
+            return int(value)
+        except ValueError:
+            raise DataValidationError('Invalid query: {0} must be an integer'.format(keyword))
+
+    def migrate(self):
+        """
+        Converts Products stored as single values to hashes and re-encodes
+        every stored Review with the current codec
+        Reviews are replaced with compare-and-set scripts, so a review that
+        another client writes in the meantime is left as it is
+        Returns the number of values that were converted or re-encoded
+        """
+        replace_item = self.redis.register_script(REPLACE_ITEM_SCRIPT)
+        header = FORMAT_VERSION + self.codec.tag
+        migrated = 0
+        keys = self.redis.scan_iter(count=1000)
+        while True:
+            chunk = list(itertools.islice(keys, self.chunk_size))
+            if not chunk:
+                return migrated
+            for key in chunk:
+                product = self.find(int(key)) if key.isdigit() else None
+                # saving moves the product and any reviews it holds out
+                if product is not None:
+                    self.save(product)
+                    migrated += 1
+            reviews = [key for key in chunk
+                       if key.startswith(b'reviews:') and key[8:].isdigit()]
+            pipe = self.redis.pipeline(transaction=False)
+            for key in reviews:
+                for index, value in enumerate(self.redis.lrange(key, 0, -1)):
+                    if not value.startswith(header):
+                        replace_item(keys=[key],
+                                     args=[index, value, self._encode(self._decode(value))],
+                                     client=pipe)
+            migrated += sum(pipe.execute())
 
     def remove_all(self):
         """ Removes all of the products from the database """
         self.redis.flushall()
+        # there are no stored products left to index
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set('catalog:indexed', 1)
+        self._execute(pipe, None, [('clear', '', '', [])])
+
+    def use_cache(self, size, ttl):
+        """
+        Caches up to size Products read by find for at most ttl seconds, or
+        turns the cache off if size is 0. Changes made by any instance of the
+        service are published on INVALIDATE_CHANNEL and drop the cached
+        Products of every instance
+        """
+        self.cache = LRUCache(size, ttl) if size > 0 else None
+        self._listen()
+
+    def use_snapshot(self, enabled):
+        """
+        Answers filtered searches from a columnar snapshot of the catalog
+        kept in memory, see CatalogSnapshot, or turns it off
+        Exception:
+        ----------
+          ValueError - if the snapshot is asked for and numpy isn't installed
+        """
+        global numpy
+        if enabled and numpy is None:
+            try:
+                import numpy
+            except ImportError:
+                raise ValueError('The catalog snapshot needs numpy to be installed')
+        self.snapshot = CatalogSnapshot(self) if enabled else None
+        # the listener of the cache serves the snapshot as well
+        if bool(self.listener) != bool(self.cache or self.snapshot):
+            self._listen()
+
+    def _listen(self):
+        """
+        Listens to INVALIDATE_CHANNEL in a thread while the cache or the
+        snapshot are used, restarting it on the current server. It has a
+        connection of its own, so it never holds one of the pool
+        """
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+        if (self.cache or self.snapshot) and self.redis:
+            pool = self.redis.connection_pool
+            redis = Redis(connection_pool=ConnectionPool(
+                connection_class=pool.connection_class, max_connections=1,
+                **pool.connection_kwargs))
+            pubsub = redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{INVALIDATE_CHANNEL: self._invalidated})
+            self.listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def version(self, client=None):
+        """
+        Returns the catalog version, bumped by every change to a Product, as
+        a string and the time of the last change in seconds since the epoch
+        Args:
+            client: the connection or pipeline to read it with, if not redis
+        """
+        return self._version((client or self.redis).mget('catalog:epoch', 'catalog:version',
+                                                         'catalog:modified'))
+
+    def product_version(self, id):
+        """
+        Returns the version of a Product, bumped by every change to it, and
+        the time of the last change to the catalog. Products stored before
+        they had versions have the catalog version
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hget(self._key(id), 'version')
+        pipe.mget('catalog:epoch', 'catalog:version', 'catalog:modified')
+        version, values = pipe.execute()
+        catalog_version, modified = self._version(values)
+        return (version.decode('utf-8') if version else catalog_version), modified
+
+    @staticmethod
+    def _version(values):
+        """ Returns the catalog version and time from their stored values """
+        epoch, version, modified = values
+        version = '{0}-{1}'.format((epoch or b'').decode('utf-8'), int(version or 0))
+        return version, int(modified or 0)
+
+    def cache_stats(self):
+        """ Returns the counters of the cache or None if it isn't used """
+        return self.cache.stats() if self.cache else None
+
+    def _execute(self, pipe, ids, events):
+        """
+        Executes a pipeline that changes the given Products, or all of them
+        if ids is None, then drops them from the cache. The catalog version
+        is bumped, the ids are published for the other instances to drop
+        and the events are appended to CHANGES_STREAM in the same pipeline
+        Args:
+            events (list): an (op, id, version, fields) tuple per change
+        """
+        ids = None if ids is None else [int(id) for id in ids]
+        args = self._change_args('*' if ids is None else ','.join(str(id) for id in ids))
+        for op, id, version, fields in events:
+            args.extend([op, id, version, ','.join(fields)])
+        change = self.redis.register_script(CHANGE_SCRIPT)
+        change(keys=CHANGE_KEYS, args=args, client=pipe)
+        pipe.execute()
+        # dropping only once the change is made keeps a find that read the
+        # data before it from caching it
+        if self.cache:
+            self.cache.drop(ids)
+
+    def _change_args(self, message):
+        """ Returns the args of CHANGE_FUNCTION for the changed ids in message """
+        # the epoch tells the versions apart after remove_all restarts them
+        return [uuid.uuid4().hex[:8], int(time.time()), INVALIDATE_CHANNEL,
+                self.instance, message, self.changes_maxlen]
+
+    def changes(self, since='0', count=100, block=None):
+        """
+        Returns the changes made to the catalog after the offset since, in
+        the order they were made, as a list of (offset, event) pairs. Each
+        event is a dictionary of the op (create, update, review, delete,
+        clear or reindex), the id and new version of the Product, the list
+        of fields that changed and the catalog version. A consumer resumes
+        from the offset of the last event it handled; a clear or reindex
+        event means it has to read the catalog again, as remove_all starts
+        the stream over and reindex picks up Products it had no events for
+        Args:
+            since (str): the offset to read after, '0' for the oldest kept
+            count (int): return at most count changes
+            block (int): milliseconds to wait for a change if there are
+                none, 0 to wait until there is one
+        """
+        if block is None:
+            streams = self.redis.xread({CHANGES_STREAM: since}, count=count)
+        else:
+            # the wait is split to end before the socket timeout does
+            timeout = self.redis.connection_pool.connection_kwargs.get('socket_timeout')
+            step = max(1, int(timeout * 500)) if timeout else None
+            deadline = time.time() + block / 1000.0
+            while True:
+                wait = block if block == 0 else max(1, int((deadline - time.time()) * 1000))
+                if step and (wait == 0 or wait > step):
+                    wait = step
+                streams = self.redis.xread({CHANGES_STREAM: since}, count=count, block=wait)
+                if streams or (block and time.time() >= deadline):
+                    break
+        changes = []
+        for _, entries in streams or []:
+            for offset, entry in entries:
+                event = dict((key.decode('utf-8'), value.decode('utf-8'))
+                             for key, value in entry.items())
+                event['id'] = int(event['id']) if event['id'] else None
+                event['fields'] = [field for field in event['fields'].split(',') if field]
+                changes.append((offset.decode('utf-8'), event))
+        return changes
+
+    def _invalidated(self, message):
+        """
+        Drops the Products of an invalidation message from the cache and
+        hands the change to the snapshot
+        """
+        instance, version, data = message['data'].decode('utf-8').split(':', 2)
+        ids = None if data == '*' else [int(id) for id in data.split(',') if id]
+        if self.snapshot:
+            self.snapshot.changed(int(version), ids)
+        # this instance dropped its own changes when it made them
+        if self.cache and instance != self.instance:
+            self.cache.drop(ids)
 
 ######################################################################
 #  R E D I S   D A T A B A S E   C O N N E C T I O N   M E T H O D S
@@ -122,6 +1248,7 @@ class Catalog:
                 logger.error("Client Connection Error!")
                 self.redis = None
                 raise ConnectionError('Could not connect to the Redis Service')
+            self._index_stored()
             return
 
         # Get the credentials from the Bluemix environment
@@ -143,19 +1270,223 @@ class Catalog:
             # if you end up here, redis instance is down.
             logger.fatal('*** FATAL ERROR: Could not connect to the Redis Service')
             raise ConnectionError('Could not connect to the Redis Service')
+        self._index_stored()
+
+    def _index_stored(self):
+        """
+        Indexes the Products of a database that was never indexed, as the
+        ones saved by versions of the service from before the indexes, so
+        that they are listed and searched
+        """
+        if not self.redis.exists('catalog:indexed'):
+            logger.info("Catalog was never indexed, indexing the stored products")
+            self.reindex()
 
     def connect_to_redis(self, hostname, port, password):
-        """ Connects to Redis and tests the connection """
+        """
+        Connects to Redis through a connection pool configured with
+        pool_options and tests the connection
+        """
         logger.info("Testing Connection to: %s:%s", hostname, port)
-        self.redis = Redis(host=hostname, port=port, password=password)
+        pool = BlockingConnectionPool(host=hostname, port=int(port), password=password,
+                                      **self.pool_options)
+        self.redis = Redis(connection_pool=pool)
         try:
             self.redis.ping()
             logger.info("Connection established")
         except ConnectionError:
             logger.info("Connection Error from: %s:%s", hostname, port)
+            pool.disconnect()
             self.redis = None
         return self.redis
 
+    def pool_stats(self):
+        """
+        Returns the number of connections the pool allows, has made, has in
+        use and has idle, or None before the database is initialized
+        The pools don't report these, so they are counted from the internals
+        of the redis-py version pinned in requirements.txt
+        """
+        if not self.redis:
+            return None
+        pool = self.redis.connection_pool
+        if isinstance(pool, BlockingConnectionPool):
+            created = len(pool._connections)
+            idle = len([connection for connection in list(pool.pool.queue) if connection])
+        else:
+            created = pool._created_connections
+            idle = len(pool._available_connections)
+        return {'max_connections': pool.max_connections, 'created': created,
+                'in_use': created - idle, 'idle': idle}
+
+
+class CatalogSnapshot(object):
+    """
+    A columnar copy of the catalog in NumPy arrays of the id, price, review
+    count, average score and lowercased name of every Product, sorted by id,
+    that answers filtered searches with vectorized masks and sorts
+    It is built from Redis on first use, then brought up to date from the
+    changes published on INVALIDATE_CHANNEL by reading back only the
+    changed Products. Searches are left to Redis while it is behind
+    """
+    # filters the snapshot can resolve
+    FILTERS = ['id', 'price', 'score_min', 'name']
+    # seconds to wait for a missing change before reading everything again
+    MAX_LAG = 5
+    # changes kept between refreshes, past them everything is read again
+    MAX_CHANGES = 1000
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        # the catalog version the columns are at, None until they are built
+        self.version = None
+        # changed ids by catalog version, None when every Product changed
+        self.changes = {}
+        # whether changes were dropped and everything has to be read again
+        self.rebuild = False
+        # when a change was first found missing, None if none is
+        self.missing_since = None
+        self.lock = threading.Lock()
+        self.refreshing = threading.Lock()
+        self.columns = self._columns([])
+
+    def changed(self, version, ids):
+        """ Records the Products changed at a catalog version """
+        with self.lock:
+            # a snapshot that isn't searched doesn't keep every change
+            if len(self.changes) >= self.MAX_CHANGES:
+                self.changes = {}
+                self.rebuild = True
+            self.changes[version] = ids
+
+    def refresh(self):
+        """
+        Brings the columns up to the current catalog version
+        Returns whether they are at it, which they aren't while another
+        thread is refreshing them or a change hasn't been received yet
+        """
+        current = self.catalog.version()[0]
+        if current == self.version:
+            return True
+        if not self.refreshing.acquire(False):
+            return False
+        try:
+            epoch, number = current.rsplit('-', 1)
+            number = int(number)
+            with self.lock:
+                changes = self.changes
+                rebuild, self.rebuild = self.rebuild, False
+                known = self.version.rsplit('-', 1) if self.version else None
+                if rebuild or known is None or known[0] != epoch or int(known[1]) > number:
+                    ids = None
+                else:
+                    versions = range(int(known[1]) + 1, number + 1)
+                    if all(version in changes for version in versions):
+                        ids = set()
+                        for version in versions:
+                            if changes[version] is None:
+                                ids = None
+                                break
+                            ids.update(changes[version])
+                    elif self.missing_since is None:
+                        self.missing_since = time.time()
+                        return False
+                    elif time.time() - self.missing_since < self.MAX_LAG:
+                        return False
+                    else:
+                        # the change may have been lost with the connection
+                        ids = None
+            if ids is None:
+                columns = self._columns(self._rows(self.catalog.ids()))
+            else:
+                columns = self._merge(self._rows(sorted(ids)), ids)
+            with self.lock:
+                self.columns = columns
+                self.version = current
+                self.missing_since = None
+                self.changes = dict((version, changed) for version, changed in changes.items()
+                                    if version > number)
+            return True
+        finally:
+            self.refreshing.release()
+
+    def search(self, filters, cursor, limit, sort):
+        """
+        Returns the ids of the Products matching normalized filters in the
+        order Catalog.search returns them, or None if the snapshot can't
+        answer the query
+        """
+        if any(keyword not in self.FILTERS for keyword in filters) or not self.refresh():
+            return None
+        ids, prices, counts, scores, names = self.columns
+        mask = numpy.ones(len(ids), dtype=bool)
+        if 'id' in filters:
+            mask &= ids == filters['id']
+        if 'price' in filters:
+            low, high = filters['price']
+            mask &= (prices >= low) & (prices <= high)
+        if 'score_min' in filters:
+            mask &= scores >= filters['score_min']
+        if 'name' in filters:
+            mask &= numpy.char.find(names, filters['name']) >= 0
+        ids = ids[mask]
+
+        if sort in Catalog.SORTS:
+            key, reverse = Catalog.SORTS[sort]
+            if key == 'index:price':
+                values = prices[mask]
+            elif key == 'index:sort:name':
+                # names are ranked to be sorted in either direction
+                values = numpy.unique(names[mask], return_inverse=True)[1]
+            else:
+                values = scores[mask]
+            # ties stay in id order either way, as in Catalog._sorted
+            order = numpy.lexsort((ids, -values if reverse else values))
+            offset = cursor or 0
+            ids = ids[order][offset:None if limit is None else offset + limit]
+        else:
+            if cursor is not None:
+                ids = ids[ids > cursor]
+            ids = ids[:limit]
+        return [int(id) for id in ids]
+
+    def _rows(self, ids):
+        """ Reads the columns of the given Products from Redis """
+        rows = []
+        for data in self.catalog.fetch(ids, ['name', 'price']):
+            product = Catalog._load(data)
+            rows.append((product.id, product.price, product.review_count,
+                         product.avg_score(), product.name.lower()))
+        return rows
+
+    def _merge(self, rows, ids):
+        """ Returns the columns with the rows of the changed ids replaced """
+        columns = self.columns
+        keep = ~numpy.in1d(columns[0], list(ids))
+        merged = self._columns(rows)
+        columns = [numpy.concatenate([column[keep], new]) for column, new in zip(columns, merged)]
+        order = numpy.argsort(columns[0], kind='mergesort')
+        return tuple(column[order] for column in columns)
+
+    @staticmethod
+    def _columns(rows):
+        """ Returns the columns of rows of id, price, count, score and name """
+        ids, prices, counts, scores, names = zip(*rows) if rows else ([], [], [], [], [])
+        return (numpy.array(ids, dtype=numpy.int64), numpy.array(prices, dtype=numpy.int64),
+                numpy.array(counts, dtype=numpy.int64), numpy.array(scores, dtype=numpy.float64),
+                numpy.array(names, dtype=numpy.unicode_))
+
+
+def new_version():
+    """ Returns a new random version for a Product """
+    return uuid.uuid4().hex[:16]
+
+
+def ngrams(text, size=3):
+    """ Returns the set of lowercased n-grams of a piece of text """
+    text = text.lower()
+    return set(text[i:i + size] for i in range(len(text) - size + 1))
+
 
 class Product(object):
     """
@@ -163,6 +1494,9 @@ class Product(object):
     required parameters: name, price. If id isn't specified, it will be
     auto-incremented when added to Catalog
     """
+    # slots keep the many Products of a listing compact, with no __dict__
+    __slots__ = ['id', 'name', 'price', 'image_id', 'description', 'version',
+                 'review_list', 'review_count', 'review_score_sum']
 
     # static variable
     catalog = Catalog()
@@ -174,10 +1508,12 @@ class Product(object):
         self.price = int(price)
         self.image_id = image_id
         self.description = description
+        # set by the catalog when the Product is saved, see Catalog.save_many
+        self.version = None
         if review_list is None:
-            self.review_list = []
+            self.set_review_list([])
         else:
-            self.review_list = review_list
+            self.set_review_list(review_list)
 
     def get_id(self):
         """ Returns product id """
@@ -220,42 +1556,60 @@ class Product(object):
         self.description = description
 
     def get_review_list(self):
-        """ Returns product review_list """
+        """ Returns product review_list, loading it from the catalog if needed """
+        if self.review_list is None:
+            self.review_list = Product.catalog.reviews(self.id)
         return self.review_list
 
     def set_review_list(self, review_list):
-        """ set product review_list """
+        """ set product review_list and recompute the review aggregates """
         self.review_list = review_list
+        self.review_count = len(review_list)
+        self.review_score_sum = sum(int(review.get_score()) for review in review_list)
 
-    def serialize(self):
-        """ Serializes a Product into a dictionary """
-        result = {"id": self.id,
-                  "name": self.name,
-                  "price": self.price,
-                  "image_id": self.image_id,
-                  "description": self.description,
-                  "review_list": [review.serialize() for review in self.review_list]
-                  }
+    def add_review(self, review):
+        """ Adds a review to the product and updates the review aggregates """
+        self.get_review_list().append(review)
+        self.review_count += 1
+        self.review_score_sum += int(review.get_score())
+
+    def serialize(self, fields=None):
+        """
+        Serializes a Product into a dictionary
+        Args:
+            fields (list): the fields to include, all of them by default.
+                The review_list is only loaded if it is included
+        """
+        result = {}
+        for field in PRODUCT_FIELDS:
+            if fields is None or field in fields:
+                result[field] = getattr(self, field)
+        if fields is None or 'review_list' in fields:
+            result["review_list"] = [review.serialize() for review in self.get_review_list()]
         return result
 
-    def deserialize(self, data):
+    def deserialize(self, data, validate=True):
         """
         Deserializes a product from a dictionary
         Args:
             data (dict): A dictionary containing the product data
+            validate (bool): whether to validate the data, which data read
+                back from the catalog skips, as it was validated when saved.
+                Data that isn't validated may hold only some of the fields
         """
-        if isinstance(data, dict) and Product.catalog.validator.validate(data):
+        if validate and not Product.catalog.validator.validate(data):
+            raise DataValidationError('Invalid product: body of request contained bad or no data')
+        if 'name' in data:
             self.name = data['name']
+        if 'price' in data:
             self.price = data['price']
-        else:
-            raise DataValidationError('Invalid product: body of request contained bad or no data')
 
         # Set optional attributes:
         for attribute in data:
             if attribute not in ['name', 'price']:
                 if hasattr(self, attribute):
                     if attribute == 'review_list':
-                        setattr(self, attribute, [Review().deserialize(review_data) for review_data in data[attribute]])
+                        self.set_review_list([Review().deserialize(review_data) for review_data in data[attribute]])
                     else:
                         setattr(self, attribute, data[attribute])
                 else:
@@ -263,20 +1617,18 @@ class Product(object):
         return self
 
     def avg_score(self):
-        res = 0.0
-        count = 0
-        if not self.review_list:
+        """ Returns the average review score from the review aggregates """
+        if not self.review_count:
             return 0.0
-        for review in self.review_list:
-            count += 1
-            res += float(review.get_score())
-        return res / count
+        return float(self.review_score_sum) / self.review_count
 
 
 class Review(object):
     """
     Class represents a review
     """
+    __slots__ = ['username', 'score', 'date', 'detail']
+
     def __init__(self, username='', score=0, date='', detail=''):
         self.username = username
         self.score = int(score)
@@ -11,12 +11,16 @@ DELETE /products/{id} - Removes a product from the database that matches the id
 
 import sys
 import logging
+import json
+import click
+from datetime import datetime
 from functools import wraps
 from flasgger import Swagger
-from flask import Flask, jsonify, request, url_for, make_response, abort
+from flask import Flask, Response, jsonify, request, url_for, make_response, abort
+from flask import stream_with_context
 from flask_api import status    # HTTP Status Codes
 from werkzeug.exceptions import NotFound
-from app.models import Product, DataValidationError, Review
+from app.models import Product, DataValidationError, Review, LRUCache, PRODUCT_FIELDS
 from . import app
 
 # Pull options from environment
@@ -54,12 +58,62 @@ HTTP_404_NOT_FOUND = 404
 HTTP_409_CONFLICT = 409
 HTTP_415_UNSUPPORTED_MEDIA_TYPE = 415
 
+# Fields a product response can be projected to with ?fields=
+RESPONSE_FIELDS = PRODUCT_FIELDS + ['review_list', 'review_count', 'avg_score']
+
+# Rendered responses by URL and catalog version, see cached_response
+response_cache = None
+if app.config['RESPONSE_CACHE_SIZE'] > 0:
+    response_cache = LRUCache(app.config['RESPONSE_CACHE_SIZE'], app.config['RESPONSE_CACHE_TTL'],
+                              app.config['RESPONSE_CACHE_BYTES'])
+
 
 ######################################################################
 # Error Handlers
 ######################################################################
 import error_handlers
 
+######################################################################
+# RESPONSE CACHE
+######################################################################
+def cached_response(version):
+    """
+    Caches the rendered response of a GET endpoint for each URL at the
+    latest version it was rendered at, tags them with the version as ETag and a Last-Modified date and answers
+    If-None-Match and If-Modified-Since with 304 NOT MODIFIED
+    Args:
+        version (function): returns the version and the time of the last
+            change of what the endpoint returns, given the same arguments
+    """
+    def decorator(function):
+        """ Wraps the endpoint """
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            """ Returns the cached response or renders and caches it """
+            etag, modified = version(*args, **kwargs)
+            key = (request.url_root, request.path,
+                   tuple(sorted(request.args.items(multi=True))), wants_ndjson())
+            cached = response_cache.get(key) if response_cache else None
+            # a response rendered at another version is replaced
+            if cached is not None and cached[0] == etag:
+                response = Response(*cached[1:])
+            else:
+                response = make_response(function(*args, **kwargs))
+                if response.status_code != HTTP_200_OK:
+                    return response
+                # streamed responses are rendered as they are sent
+                if response_cache and not response.is_streamed:
+                    data = response.get_data()
+                    response_cache.put(key, (etag, data, response.status_code,
+                                             response.headers.to_wsgi_list()),
+                                       response_cache.generation, len(data))
+            response.set_etag(etag)
+            response.last_modified = datetime.utcfromtimestamp(modified)
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+
 ######################################################################
 # GET HEALTH CHECK
 ######################################################################
@@ -71,6 +125,16 @@ def healthcheck():
     return make_response(jsonify(status=200, message='Healthy'), status.HTTP_200_OK)
 
 
+######################################################################
+# GET STATS
+######################################################################
+@app.route('/stats')
+def stats():
+    """ Let operators see how the Redis connection pool and the cache are used """
+    return make_response(jsonify(redis_pool=Product.catalog.pool_stats(),
+                                 cache=Product.catalog.cache_stats()), status.HTTP_200_OK)
+
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -113,6 +177,7 @@ def delete_products(id):
 # LIST PRODUCTS
 ######################################################################
 @app.route('/products', methods=['GET'])
+@cached_response(lambda: Product.catalog.version())
 def list_products():
     """
     Retrieves a list of products from the database
@@ -132,9 +197,20 @@ def list_products():
         description: query the product that match the name
       - in: query
         name: price
-        type: number
-        format: float
+        type: integer
         description: query the product that match the price
+      - in: query
+        name: price_min
+        type: integer
+        description: query the product with a price greater than or equal to price_min
+      - in: query
+        name: price_max
+        type: integer
+        description: query the product with a price less than or equal to price_max
+      - in: query
+        name: score_min
+        type: number
+        description: query the product with an average review score greater than or equal to score_min
       - in: query
         name: image_id
         type: integer
@@ -147,6 +223,23 @@ def list_products():
         name: sort
         type: string
         description: use "price", "price-", "review", "name", "name-" to sort the product list
+      - in: query
+        name: limit
+        type: integer
+        description: return at most this many products, with a Link header to the next page
+      - in: query
+        name: include_reviews
+        type: boolean
+        default: true
+        description: set to false to return a review_count and avg_score instead of the review_list
+      - in: query
+        name: fields
+        type: string
+        description: a comma separated list of the fields to return, e.g. "id,name,price"
+      - in: query
+        name: cursor
+        type: string
+        description: the cursor of the next page taken from the Link header of the previous page
     definitions:
       Product:
         type: object
@@ -208,52 +301,76 @@ def list_products():
             schema:
               $ref: '#/definitions/Product'
     """
-    results = []
-    if request.args:
-        temp = Product.catalog.all()
-        for keyword in request.args:
-            if keyword != 'sort':
-                # logging.info('set(temp) before search: ' + str(set(temp)))
-                matches = set(Product.catalog.query(
-                    keyword, request.args[keyword]))
-                # logging.info('matches: ' + str(matches))
-                set1 = set(x.id for x in temp)
-                set2 = set(x.id for x in matches)
-                intersection_ids = set1 & set2
-                temp = [item for item in matches if item.id in intersection_ids]
-                # logging.info('set(temp) after search: ' + str(set(temp)))
-        results = temp
-    else:
-        results = Product.catalog.all()
-    products = results
+    filters = dict((keyword, value) for keyword, value in request.args.items()
+                   if keyword not in ['sort', 'limit', 'cursor', 'include_reviews', 'fields'])
     sort_type = request.args.get('sort')
-    if sort_type == 'price':
-        """ Retrieves a list of products with the lowest price showed first from the database """
-        results = sorted(products, key=lambda p: float(
-            p.get_price()), reverse=False)
-    elif sort_type == 'price-':
-        """ Retrieves a list of products with the highest price showed first from the database """
-        results = sorted(products, key=lambda p: float(
-            p.get_price()), reverse=True)
-    elif sort_type == 'review':
-        """ Retrieves a list of products with the highest review showed first from the database """
-        results = sorted(products, key=lambda p: p.avg_score(), reverse=True)
-    elif sort_type == 'name':
-        """ Retrieves a list of products in alphabetical order from the database """
-        results = sorted(
-            products, key=lambda p: p.get_name().lower(), reverse=False)
-    elif sort_type == 'name-':
-        """ Retrieves a list of products in reverse alphabetical order from the database """
-        results = sorted(
-            products, key=lambda p: p.get_name().lower(), reverse=True)
-
-    return make_response(jsonify([product.serialize() for product in results]), HTTP_200_OK)
+    limit = get_int_arg('limit', minimum=1)
+    cursor = get_int_arg('cursor', minimum=0)
+    fields = get_fields_arg()
+    if wants_ndjson() and not filters and not sort_type and limit is None and cursor is None:
+        return export_response(fields)
+    results = Product.catalog.search(filters, cursor, limit, sort_type, stored_fields(fields))
+    if sort_type in Product.catalog.SORTS:
+        # the cursor is the number of products on the previous pages
+        next_cursor = (cursor or 0) + len(results)
+    else:
+        # the cursor is the id of the last product of the previous page
+        next_cursor = results[-1].id if results else None
+
+    headers = {}
+    if limit is not None and len(results) == limit:
+        args = request.args.to_dict()
+        args['cursor'] = next_cursor
+        headers['Link'] = '<{0}>; rel="next"'.format(
+            url_for('list_products', _external=True, **args))
+    if 'review_list' in fields:
+        Product.catalog.load_reviews(results)
+    if wants_ndjson():
+        return Response((json.dumps(serialize_product(product, fields)) + '\n'
+                         for product in results), mimetype='application/x-ndjson',
+                        headers=headers)
+    return make_response(jsonify([serialize_product(product, fields)
+                                  for product in results]), HTTP_200_OK, headers)
+
+
+######################################################################
+# EXPORT ALL PRODUCTS
+######################################################################
+@app.route('/products/export', methods=['GET'])
+def export_products():
+    """ Exports every product as newline delimited JSON
+    This endpoint will stream the whole catalog one product per line, reading
+    it from the database a chunk at a time. GET /products also streams the
+    catalog this way when asked for application/x-ndjson without filters
+    ---
+    tags:
+      - Products
+    produces:
+      - application/x-ndjson
+    parameters:
+      - in: query
+        name: include_reviews
+        type: boolean
+        default: true
+        description: set to false to return a review_count and avg_score instead of the review_list
+      - in: query
+        name: fields
+        type: string
+        description: a comma separated list of the fields to return, e.g. "id,name,price"
+    responses:
+      200:
+        description: One Product per line, in id order
+        schema:
+          $ref: '#/definitions/Product'
+    """
+    return export_response(get_fields_arg())
 
 
 ######################################################################
 # RETRIEVE A PRODUCT BY ID
 ######################################################################
 @app.route('/products/<int:id>', methods=['GET'])
+@cached_response(lambda id: Product.catalog.product_version(id))
 def get_products(id):
     """ Retrieves a Product with a specific id
     This endpoint will return a Product based on it's id
@@ -268,6 +385,15 @@ def get_products(id):
         description: ID of product to retrieve
         type: integer
         required: true
+      - in: query
+        name: include_reviews
+        type: boolean
+        default: true
+        description: set to false to return a review_count and avg_score instead of the review_list
+      - in: query
+        name: fields
+        type: string
+        description: a comma separated list of the fields to return, e.g. "id,name,price"
     responses:
       200:
         description: Product returned
@@ -276,12 +402,68 @@ def get_products(id):
       404:
         description: Product not found
     """
-    product = Product.catalog.find(id)
+    fields = get_fields_arg()
+    product = Product.catalog.find(id, stored_fields(fields))
     if not product:
         abort(HTTP_404_NOT_FOUND, "Product with id '{}' was not found.".format(id))
 
-    return make_response(jsonify(product.serialize()), HTTP_200_OK)
-  
+    return make_response(jsonify(serialize_product(product, fields)), HTTP_200_OK)
+
+
+######################################################################
+# LIST THE REVIEWS OF A PRODUCT
+######################################################################
+@app.route('/products/<int:id>/reviews', methods=['GET'])
+def list_product_reviews(id):
+    """ Retrieves the reviews of a Product one page at a time
+    This endpoint will return the reviews of a Product in the order they were added
+    ---
+    tags:
+      - Products
+    produces:
+      - application/json
+    parameters:
+      - name: id
+        in: path
+        description: ID of product whose reviews to retrieve
+        type: integer
+        required: true
+      - in: query
+        name: limit
+        type: integer
+        description: return at most this many reviews, with a Link header to the next page
+      - in: query
+        name: cursor
+        type: integer
+        description: the number of reviews to skip, taken from the Link header of the previous page
+    responses:
+      200:
+        description: An array of Reviews
+        schema:
+          type: array
+          items:
+            schema:
+              $ref: '#/definitions/Review'
+      404:
+        description: Product not found
+    """
+    if not Product.catalog.exists(id):
+        abort(HTTP_404_NOT_FOUND, "Product with id '{}' was not found.".format(id))
+
+    limit = get_int_arg('limit', minimum=1)
+    start = get_int_arg('cursor', minimum=0) or 0
+    stop = -1 if limit is None else start + limit - 1
+    reviews = Product.catalog.reviews(id, start, stop)
+
+    headers = {}
+    if limit is not None and len(reviews) == limit:
+        args = request.args.to_dict()
+        args['cursor'] = start + len(reviews)
+        headers['Link'] = '<{0}>; rel="next"'.format(
+            url_for('list_product_reviews', id=id, _external=True, **args))
+    return make_response(jsonify([review.serialize() for review in reviews]),
+                         HTTP_200_OK, headers)
+
 
 ######################################################################
 # ADD A NEW PRODUCT
@@ -466,6 +648,10 @@ def update_products(id):
               type: string
               description: description for the product
 
+      - in: header
+        name: If-Match
+        type: string
+        description: the ETag of the product, to only update it if it wasn't changed since
     responses:
       200:
         description: Product Updated
@@ -473,6 +659,8 @@ def update_products(id):
           $ref: '#/definitions/Product'
       400:
         description: Bad Request (the posted data was not valid)
+      412:
+        description: Precondition Failed (the product was changed since the ETag in If-Match)
     """
     check_content_type('application/json')
     product = Product.catalog.find(id)
@@ -483,8 +671,170 @@ def update_products(id):
     if 'price' in data:
         data['price'] = int(data['price'])
     product.deserialize(data)
-    Product.catalog.save(product)
-    return make_response(jsonify(product.serialize()), HTTP_200_OK)
+    Product.catalog.save(product, get_if_match())
+    response = make_response(jsonify(product.serialize()), HTTP_200_OK)
+    response.set_etag(product.version)
+    return response
+
+
+######################################################################
+# ADD OR UPDATE MANY PRODUCTS
+######################################################################
+@app.route('/products/batch', methods=['POST'])
+def create_products_batch():
+    """ Creates or updates many products at once
+    This endpoint will save every valid Product in the list that is posted
+    in a single transaction. Products with an id update the existing Product
+    ---
+    tags:
+      - Products
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            $ref: '#/definitions/Product'
+    responses:
+      200:
+        description: The result of each product, in the order they were posted
+        schema:
+          type: array
+          items:
+            type: object
+            properties:
+              status:
+                type: integer
+                description: 201 if created, 200 if updated, 400 or 404 if not saved
+              id:
+                type: integer
+                description: id of the saved product
+              message:
+                type: string
+                description: why the product was not saved
+      400:
+        description: Bad Request (the posted data was not a list)
+    """
+    check_content_type('application/json')
+    items = request.get_json()
+    if not isinstance(items, list):
+        abort(HTTP_400_BAD_REQUEST, 'body of request must be a list of products')
+
+    return make_response(jsonify(save_products(items)), HTTP_200_OK)
+
+
+######################################################################
+# DELETE MANY PRODUCTS
+######################################################################
+@app.route('/products/batch', methods=['DELETE'])
+def delete_products_batch():
+    """ Removes many Products from the database at once
+    This endpoint will delete the Products with the ids in the list that is
+    posted in a single transaction
+    ---
+    tags:
+      - Products
+    consumes:
+      - application/json
+    produces:
+      - application/json
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: array
+          items:
+            type: integer
+    responses:
+      200:
+        description: The result of each id, 204 if deleted or 404 if not found
+      400:
+        description: Bad Request (the posted data was not a list of ids)
+    """
+    check_content_type('application/json')
+    ids = request.get_json()
+    if not isinstance(ids, list) or not all(isinstance(id, int) for id in ids):
+        abort(HTTP_400_BAD_REQUEST, 'body of request must be a list of product ids')
+
+    deleted = set(Product.catalog.delete_many(ids))
+    return make_response(jsonify([{'id': id, 'status': HTTP_204_NO_CONTENT if id in deleted
+                                   else HTTP_404_NOT_FOUND} for id in ids]), HTTP_200_OK)
+
+
+######################################################################
+# IMPORT PRODUCTS
+######################################################################
+@app.route('/products/import', methods=['POST'])
+def import_products():
+    """ Imports a stream of newline delimited JSON products
+    This endpoint will read the posted body one line at a time and save the
+    valid Products in chunks, so an import of any size uses constant memory.
+    Products with an id update the existing Product
+    ---
+    tags:
+      - Products
+    consumes:
+      - application/x-ndjson
+    produces:
+      - application/x-ndjson
+    parameters:
+      - in: body
+        name: body
+        required: true
+        description: one Product per line
+        schema:
+          $ref: '#/definitions/Product'
+    responses:
+      200:
+        description: >
+          A stream of newline delimited JSON: an error for each line that was
+          not saved, the progress after each chunk is saved and a summary
+    """
+    check_content_type('application/x-ndjson')
+    chunk_size = app.config['CATALOG_CHUNK_SIZE']
+
+    def read_chunks():
+        """ Yields the numbered non blank lines of the body in chunks """
+        chunk = []
+        for number, line in enumerate(request.stream, 1):
+            if line.strip():
+                chunk.append((number, line))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def generate():
+        """ Saves the products a chunk at a time, reporting as it goes """
+        imported = errors = 0
+        for chunk in read_chunks():
+            items = []
+            for number, line in chunk:
+                try:
+                    items.append((number, json.loads(line)))
+                except ValueError as error:
+                    errors += 1
+                    yield json.dumps({'line': number, 'status': HTTP_400_BAD_REQUEST,
+                                      'message': str(error)}) + '\n'
+            results = save_products([data for _, data in items])
+            for (number, _), result in zip(items, results):
+                if result['status'] in [HTTP_200_OK, HTTP_201_CREATED]:
+                    imported += 1
+                else:
+                    errors += 1
+                    result['line'] = number
+                    yield json.dumps(result) + '\n'
+            yield json.dumps({'imported': imported, 'errors': errors}) + '\n'
+        yield json.dumps({'done': True, 'imported': imported, 'errors': errors}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 
 ######################################################################
@@ -532,6 +882,10 @@ def review_products(id):
               type: string
               description: review detail description
 
+      - in: header
+        name: If-Match
+        type: string
+        description: the ETag of the product, to only add the review if it wasn't changed since
     responses:
       200:
         description: Review Updated
@@ -539,27 +893,27 @@ def review_products(id):
           $ref: '#/definitions/Review'
       400:
         description: Bad Request (the posted data was not valid)
+      412:
+        description: Precondition Failed (the product was changed since the ETag in If-Match)
     """
-    product = Product.catalog.find(id)
+    payload = request.get_json()
+    # Ensure that required attributes are provided:
+    if ('username' not in payload or 'score' not in payload):
+        abort(400)
+    review = Review(username=payload['username'], date=payload.get('date', ''),
+                    score=payload['score'], detail=payload.get('detail', ''))
+    # Pass on new review to product:
+    product = Product.catalog.add_review(id, review, get_if_match())
     if product:
-        payload = request.get_json()
-        # Ensure that required attributes are provided:
-        if ('username' not in payload or 'score' not in payload):
-            abort(400)
-        # Pass on new review to product:
-        review = Review(username=payload['username'], date=payload['date'],
-                        score=payload['score'], detail=payload['detail'])
-        review_list = product.get_review_list()
-        review_list.append(review)
-        product.set_review_list(review_list)
-        Product.catalog.save(product)
         message = product.serialize()
         return_code = HTTP_200_OK
+        headers = {'ETag': '"{0}"'.format(product.version)}
     else:
         message = {'error': 'Product with id: %s was not found' % str(id)}
         return_code = HTTP_404_NOT_FOUND
+        headers = {}
 
-    return jsonify(message), return_code
+    return jsonify(message), return_code, headers
 
 
 ######################################################################
@@ -569,7 +923,37 @@ def review_products(id):
 @app.before_first_request
 def init_db(redis=None):
     """ Initlaize the model """
+    Product.catalog.chunk_size = app.config['CATALOG_CHUNK_SIZE']
+    Product.catalog.changes_maxlen = app.config['CATALOG_CHANGES_MAXLEN']
+    Product.catalog.use_codec(app.config['CATALOG_CODEC'])
+    Product.catalog.pool_options = {
+        'max_connections': app.config['REDIS_MAX_CONNECTIONS'],
+        'timeout': app.config['REDIS_POOL_TIMEOUT'],
+        'socket_timeout': app.config['REDIS_SOCKET_TIMEOUT'],
+        'socket_connect_timeout': app.config['REDIS_CONNECT_TIMEOUT'],
+        'socket_keepalive': True,
+        'retry_on_timeout': True,
+        'health_check_interval': app.config['REDIS_HEALTH_CHECK_INTERVAL']
+    }
     Product.catalog.init_db(redis)
+    Product.catalog.use_cache(app.config['CATALOG_CACHE_SIZE'], app.config['CATALOG_CACHE_TTL'])
+    Product.catalog.use_snapshot(app.config['CATALOG_SNAPSHOT'])
+
+
+@app.cli.command('reindex')
+def reindex():
+    """ Rebuilds the indexes from the stored products """
+    init_db()
+    Product.catalog.reindex()
+    click.echo('Indexed {0} products'.format(len(Product.catalog.ids())))
+
+
+@app.cli.command('migrate-codec')
+def migrate_codec():
+    """ Re-encodes the stored products with the configured codec """
+    init_db()
+    count = Product.catalog.migrate()
+    click.echo('Re-encoded {0} values with {1}'.format(count, app.config['CATALOG_CODEC']))
 
 
 # load sample data
@@ -584,6 +968,133 @@ def data_reset():
     Product.catalog.remove_all()
 
 
+def serialize_product(product, fields):
+    """ Serializes the given fields of a product, including the review summary ones """
+    data = product.serialize(fields)
+    if 'review_count' in fields:
+        data['review_count'] = product.review_count
+    if 'avg_score' in fields:
+        data['avg_score'] = product.avg_score()
+    return data
+
+
+def get_fields_arg():
+    """
+    Returns the fields asked for with the fields query parameter
+    Without it every field is returned, with a review summary in place of
+    the review_list when include_reviews is false
+    """
+    value = request.args.get('fields')
+    if value is None:
+        if get_bool_arg('include_reviews', True):
+            return PRODUCT_FIELDS + ['review_list']
+        return PRODUCT_FIELDS + ['review_count', 'avg_score']
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    for field in fields:
+        if field not in RESPONSE_FIELDS:
+            abort(HTTP_400_BAD_REQUEST, "Unknown field '{0}', use one of {1}".format(
+                field, ', '.join(RESPONSE_FIELDS)))
+    return fields
+
+
+def stored_fields(fields):
+    """ Returns the stored fields needed to respond with the given fields """
+    return [field for field in PRODUCT_FIELDS if field in fields]
+
+
+def export_response(fields):
+    """ Returns a response that streams the given fields of every product """
+    def generate():
+        """ Serializes the catalog a chunk at a time """
+        for products in Product.catalog.iter_chunks(stored_fields(fields)):
+            if 'review_list' in fields:
+                Product.catalog.load_reviews(products)
+            for product in products:
+                yield json.dumps(serialize_product(product, fields)) + '\n'
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+def wants_ndjson():
+    """ Returns whether the client asked for newline delimited JSON """
+    best = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson'])
+    return best == 'application/x-ndjson'
+
+
+def save_products(items):
+    """
+    Validates a list of products and saves the valid ones in a single
+    transaction. Products with an id are merged into the existing Product
+    like PUT /products/<id> does
+    Returns the result of each item, in order
+    """
+    results = []
+    products = []
+    for data in items:
+        try:
+            if 'price' in data:
+                data['price'] = int(data['price'])
+            product = Product().deserialize(data)
+            product.set_id(product.id or 0)
+        except (DataValidationError, TypeError, ValueError) as error:
+            results.append({'status': HTTP_400_BAD_REQUEST, 'message': str(error)})
+            continue
+        results.append({'status': HTTP_200_OK if product.id > 0 else HTTP_201_CREATED})
+        products.append((product, data, results[-1]))
+
+    # updates are merged into the stored products, which keep their reviews
+    # unless they are replaced, and those that don't exist are not saved
+    existing = dict((product.id, product) for product in Product.catalog.find_many(
+        [product.id for product, _, _ in products if product.id > 0]))
+    merged = []
+    for product, data, result in products:
+        if product.id > 0:
+            if product.id not in existing:
+                result['status'] = HTTP_404_NOT_FOUND
+                result['message'] = "Product with id '{}' was not found.".format(product.id)
+                continue
+            product = existing[product.id]
+            product.deserialize(data)
+        merged.append((product, result))
+    products = merged
+
+    Product.catalog.save_many([product for product, _ in products])
+    for product, result in products:
+        result['id'] = product.id
+    return results
+
+
+def get_if_match():
+    """
+    Returns the product versions in the If-Match header, or None when it
+    isn't given or is * and any version will do
+    """
+    if 'If-Match' not in request.headers or request.if_match.star_tag:
+        return None
+    return list(request.if_match.as_set())
+
+
+def get_bool_arg(name, default):
+    """ Returns a boolean query parameter or default when it isn't given """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    return value.lower() not in ['false', '0', 'no']
+
+
+def get_int_arg(name, minimum=None):
+    """ Returns an integer query parameter or None when it isn't given """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        abort(HTTP_400_BAD_REQUEST, '{0} must be an integer'.format(name))
+    if minimum is not None and value < minimum:
+        abort(HTTP_400_BAD_REQUEST, '{0} must be at least {1}'.format(name, minimum))
+    return value
+
+
 def check_content_type(content_type):
     """ Checks that the media type is correct """
     if request.headers['Content-Type'] == content_type:
@@ -0,0 +1,63 @@
+"""
+Codec Benchmark
+
+Compares the encode and decode throughput and the stored size of a
+product with the pickle format products used to be stored with and with
+each of the storage codecs in app/models.py
+
+Run it from the root of the repo with:
+  python -m benchmarks.codec_benchmark
+"""
+
+import pickle
+import timeit
+from app.models import CODECS, FORMAT_VERSION
+
+REPEAT = 5
+
+
+def make_product(id, review_count):
+    """ Returns a serialized product the way the catalog stores it """
+    return {
+        "id": id,
+        "name": u"Product {0}".format(id),
+        "price": 100 + id,
+        "image_id": u"{0:04d}".format(id),
+        "description": u"A fairly typical description of a product " * 4,
+        "review_list": [{"username": u"user{0}".format(i),
+                         "score": i % 5 + 1,
+                         "date": u"2018/04/05",
+                         "detail": u"Works as described, would buy again."}
+                        for i in range(review_count)]
+    }
+
+
+def measure(encode, decode, data, number):
+    """ Returns encodes per second, decodes per second and encoded bytes """
+    value = encode(data)
+    encode_time = min(timeit.repeat(lambda: encode(data), repeat=REPEAT, number=number))
+    decode_time = min(timeit.repeat(lambda: decode(value), repeat=REPEAT, number=number))
+    return number / encode_time, number / decode_time, len(value)
+
+
+def main():
+    """ Prints a table for products with no, a few and many reviews """
+    formats = [('pickle', pickle.dumps, pickle.loads)]
+    for name, codec in sorted(CODECS.items()):
+        header = FORMAT_VERSION + codec.tag
+        formats.append((name,
+                        lambda data, codec=codec, header=header: header + codec.encode(data),
+                        lambda value, codec=codec: codec.decode(value[2:])))
+
+    print '{0:>8} {1:>10} {2:>14} {3:>14} {4:>10}'.format(
+        'reviews', 'format', 'encodes/s', 'decodes/s', 'bytes')
+    for review_count, number in [(0, 20000), (10, 5000), (1000, 50)]:
+        data = make_product(1, review_count)
+        for name, encode, decode in formats:
+            encodes, decodes, size = measure(encode, decode, data, number)
+            print '{0:>8} {1:>10} {2:>14,.0f} {3:>14,.0f} {4:>10,}'.format(
+                review_count, name, encodes, decodes, size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Deserialize Benchmark
+
+Compares the throughput of Product.deserialize for products validated
+with Cerberus, as every product used to be, with the compiled
+SchemaValidator used for client input, and with the trusted path that
+products read back from the catalog take
+
+Cerberus is no longer a dependency of the service, its row is skipped
+unless it is installed. Run it from the root of the repo with:
+  python -m benchmarks.deserialize_benchmark
+"""
+
+import timeit
+from app.models import Product, PRODUCT_SCHEMA
+from benchmarks.codec_benchmark import make_product
+
+try:
+    from cerberus import Validator
+except ImportError:  # only needed for the before row
+    Validator = None
+
+REPEAT = 5
+
+
+def measure(deserialize, data, number):
+    """ Returns deserializes per second """
+    deserialize(data)
+    return number / min(timeit.repeat(lambda: deserialize(data), repeat=REPEAT, number=number))
+
+
+def main():
+    """ Prints a table for products with no and a few reviews """
+    paths = []
+    if Validator is not None:
+        # a validator that deserialize is pointed at for the before row
+        paths.append(('cerberus', Validator(PRODUCT_SCHEMA), True))
+    paths.append(('compiled', Product.catalog.validator, True))
+    paths.append(('trusted', Product.catalog.validator, False))
+
+    print '{0:>8} {1:>10} {2:>16}'.format('reviews', 'path', 'deserializes/s')
+    for review_count, number in [(0, 20000), (10, 5000)]:
+        data = make_product(1, review_count)
+        for name, validator, validate in paths:
+            Product.catalog.validator = validator
+            deserializes = measure(lambda data: Product().deserialize(data, validate),
+                                   data, number)
+            print '{0:>8} {1:>10} {2:>16,.0f}'.format(review_count, name, deserializes)
+        Product.catalog.validator = paths[-1][1]
+
+
+if __name__ == '__main__':
+    main()
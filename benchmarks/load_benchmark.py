@@ -0,0 +1,103 @@
+"""
+Load Benchmark
+
+Reports the requests per second of GET /products and GET /products/<id>
+served by the development server of run.py and by the gevent server of
+run_gevent.py, with as many clients at once as CLIENTS
+
+Both servers are a single process pinned to the same CPU, and the caches
+are turned off so every request goes to Redis. The gevent server gains
+the most when Redis is on another host, as requests overlap the network
+round trips; with a local Redis both are mostly bound by the CPU. The
+products are created before and deleted after each run. Start Redis and
+run it from the root of the repo with:
+  python -m benchmarks.load_benchmark
+"""
+
+import os
+import sys
+import time
+import json
+import threading
+import subprocess
+import requests
+
+PORT = 5099
+URL = 'http://localhost:{0}'.format(PORT)
+PRODUCTS = 200
+CLIENTS = 20
+SECONDS = 10
+# the CPU both servers run on
+CPU = '0'
+MODES = [('run.py', 'development'), ('run_gevent.py', 'gevent')]
+
+
+def start(script):
+    """ Starts a server on one CPU and waits until it answers """
+    env = dict(os.environ, PORT=str(PORT), CATALOG_CACHE_SIZE='0', RESPONSE_CACHE_SIZE='0',
+               REDIS_MAX_CONNECTIONS=str(CLIENTS + 1))
+    command = [sys.executable, script]
+    if os.path.exists('/usr/bin/taskset'):
+        command = ['taskset', '-c', CPU] + command
+    process = subprocess.Popen(command, env=env, stdout=open(os.devnull, 'w'),
+                               stderr=subprocess.STDOUT)
+    for _ in range(100):
+        try:
+            requests.get(URL + '/')
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('{0} did not start'.format(script))
+
+
+def client(paths, deadline, counts, index):
+    """ Requests the paths in turn until the deadline, counting the responses """
+    session = requests.Session()
+    done = 0
+    while time.time() < deadline:
+        response = session.get(URL + paths[done % len(paths)])
+        response.raise_for_status()
+        done += 1
+    counts[index] = done
+
+
+def measure(paths):
+    """ Returns the requests per second of CLIENTS clients over SECONDS """
+    counts = [0] * CLIENTS
+    deadline = time.time() + SECONDS
+    threads = [threading.Thread(target=client, args=(paths, deadline, counts, index))
+               for index in range(CLIENTS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / float(SECONDS)
+
+
+def main():
+    """ Prints a table of requests per second for each server and endpoint """
+    print '{0:>12} {1:>24} {2:>12}'.format('server', 'endpoint', 'requests/s')
+    for script, name in MODES:
+        process = start(script)
+        try:
+            products = [{'name': 'Product {0}'.format(index), 'price': 100 + index,
+                         'description': 'A fairly typical description'}
+                        for index in range(PRODUCTS)]
+            response = requests.post(URL + '/products/batch', json=products)
+            ids = [product['id'] for product in response.json()]
+            try:
+                for endpoint, paths in [
+                        ('/products?limit=20', ['/products?limit=20']),
+                        ('/products/<id>', ['/products/{0}'.format(id) for id in ids])]:
+                    print '{0:>12} {1:>24} {2:>12,.0f}'.format(name, endpoint, measure(paths))
+            finally:
+                requests.delete(URL + '/products/batch', data=json.dumps(ids),
+                                headers={'Content-Type': 'application/json'})
+        finally:
+            process.kill()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
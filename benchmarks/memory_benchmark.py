@@ -0,0 +1,72 @@
+"""
+Memory Benchmark
+
+Reports the bytes each Product of a listing takes, with its Reviews, for
+the slotted Product and Review classes and for the same attributes held
+in a __dict__ as the classes used to
+
+The catalog has a realistic spread of reviews: most products have a few
+and some have many. Run it from the root of the repo with:
+  python -m benchmarks.memory_benchmark
+"""
+
+import sys
+from app.models import Product
+from benchmarks.codec_benchmark import make_product
+
+PRODUCTS = 1000
+# review counts of a catalog, repeated over its products
+REVIEW_COUNTS = [0, 0, 1, 2, 3, 5, 8, 12, 20, 50]
+
+
+class DictBacked(object):
+    """ Holds the attributes of an object in a __dict__ """
+    pass
+
+
+def as_dict_backed(value):
+    """ Returns a copy of a Product or Review whose attributes are in a __dict__ """
+    copy = DictBacked()
+    for attribute in type(value).__slots__:
+        item = getattr(value, attribute)
+        if isinstance(item, list):
+            item = [as_dict_backed(review) for review in item]
+        setattr(copy, attribute, item)
+    return copy
+
+
+def deep_size(value, seen):
+    """ Returns the bytes of a value and of everything it refers to """
+    if id(value) in seen or isinstance(value, type):
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(key, seen) + deep_size(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in value)
+    if hasattr(value, '__dict__'):
+        size += deep_size(value.__dict__, seen)
+    for attribute in getattr(type(value), '__slots__', []):
+        size += deep_size(getattr(value, attribute, None), seen)
+    return size
+
+
+def main():
+    """ Prints the bytes per product of each representation """
+    products = []
+    for number in range(1, PRODUCTS + 1):
+        data = make_product(number, REVIEW_COUNTS[number % len(REVIEW_COUNTS)])
+        products.append(Product().deserialize(data, validate=False))
+    reviews = sum(len(product.review_list) for product in products)
+
+    print '{0} products with {1:.1f} reviews on average'.format(
+        PRODUCTS, float(reviews) / PRODUCTS)
+    print '{0:>10} {1:>16}'.format('classes', 'bytes/product')
+    for name, listing in [('dict', [as_dict_backed(product) for product in products]),
+                          ('slots', products)]:
+        print '{0:>10} {1:>16,.0f}'.format(name, float(deep_size(listing, set())) / PRODUCTS)
+
+
+if __name__ == '__main__':
+    main()
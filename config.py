@@ -1,3 +1,32 @@
+import os
 import logging
 SECRET_KEY = 'secret-for-dev'
 LOGGING_LEVEL = logging.INFO
+# Number of products fetched per Redis round trip when listing the catalog
+CATALOG_CHUNK_SIZE = 500
+# Codec Products and Reviews are stored with: 'msgpack' or 'json'
+CATALOG_CODEC = 'msgpack'
+# Redis connection pool of each worker, overridable from the environment
+# (e.g. cf set-env) to fit the connection limit of the bound Redis plan
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', '10'))
+# Seconds to wait for a free connection when all of them are in use
+REDIS_POOL_TIMEOUT = float(os.getenv('REDIS_POOL_TIMEOUT', '5'))
+REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', '5'))
+REDIS_CONNECT_TIMEOUT = float(os.getenv('REDIS_CONNECT_TIMEOUT', '2'))
+# Seconds a connection can be idle before it is checked with a PING
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', '30'))
+# Products cached in each worker for GET /products/<id>, 0 turns it off,
+# and the seconds a cached product may be served for
+CATALOG_CACHE_SIZE = int(os.getenv('CATALOG_CACHE_SIZE', '1000'))
+CATALOG_CACHE_TTL = float(os.getenv('CATALOG_CACHE_TTL', '30'))
+# Rendered GET /products and GET /products/<id> responses cached in each
+# worker per URL at its latest catalog version, 0 turns it off, and the
+# bytes all of the cached responses may take
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '200'))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '300'))
+RESPONSE_CACHE_BYTES = int(os.getenv('RESPONSE_CACHE_BYTES', str(4 * 1024 * 1024)))
+# About how many events the catalog:changes stream keeps
+CATALOG_CHANGES_MAXLEN = int(os.getenv('CATALOG_CHANGES_MAXLEN', '10000'))
+# Answer filtered GET /products from a column snapshot of the catalog kept
+# in each worker, needs numpy
+CATALOG_SNAPSHOT = os.getenv('CATALOG_SNAPSHOT', 'False') == 'True'
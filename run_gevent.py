@@ -0,0 +1,31 @@
+"""
+Concurrent Product Service Runner
+
+Serves the Product Service with gevent instead of the single threaded
+development server. The standard library is patched first, so every
+request runs in its own greenlet and waits on its Redis round trips
+without blocking the others
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import os
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from app import app, server
+
+# Pull options from environment
+PORT = os.getenv('PORT', '5000')
+# Requests served at once, each holds a Redis connection while it waits
+CONCURRENCY = int(os.getenv('CONCURRENCY', '100'))
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    print "****************************************"
+    print " P R O D U C T   S E R V I C E   R U N N I N G"
+    print "****************************************"
+    server.initialize_logging()
+    WSGIServer(('0.0.0.0', int(PORT)), app, spawn=Pool(CONCURRENCY), log=None).serve_forever()
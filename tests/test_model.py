@@ -22,12 +22,18 @@ Test cases can be run with:
 import unittest
 import os
 
+import time
+import threading
 import logging
 from mock import patch
 from redis import Redis
+from redis.connection import Connection
 from redis.exceptions import ConnectionError
 import json
-from app.models import Product, DataValidationError, Review
+import pickle
+from app import models
+from app.models import Product, DataValidationError, Review, SchemaValidator
+from app.custom_exceptions import VersionConflictError
 
 # For testing, our VCAP points to the Travis CI localhost
 VCAP_SERVICES = os.getenv('VCAP_SERVICES', None)
@@ -118,6 +124,37 @@ class TestProducts(unittest.TestCase):
         # delete the product and make sure it isn't in the catalog
         Product.catalog.delete(self.product.id)
         self.assertEqual(len(Product.catalog.all()), 0)
+        self.assertEqual(Product.catalog.ids(), [])
+
+    def test_product_id_index(self):
+        """ Keep the product id index in id order """
+        Product.catalog.save(Product(name="Samsung", price=749, id=10))
+        Product.catalog.save(self.product)
+        Product.catalog.save(Product(name="Pixel", price=649, id=2))
+        self.assertEqual(Product.catalog.ids(), [1, 2, 10])
+        self.assertEqual([p.id for p in Product.catalog.all()], [1, 2, 10])
+
+    def test_find_many_products(self):
+        """ Find many products with chunked bulk fetches """
+        for name in ["iPhone", "Samsung", "Pixel", "Nokia", "Moto"]:
+            Product.catalog.save(Product(name=name, price=649))
+        chunk_size = Product.catalog.chunk_size
+        Product.catalog.chunk_size = 2
+        try:
+            products = Product.catalog.find_many([5, 1, 42, 3])
+            self.assertEqual([p.name for p in products], ["Moto", "iPhone", "Pixel"])
+            self.assertEqual(len(Product.catalog.all()), 5)
+        finally:
+            Product.catalog.chunk_size = chunk_size
+
+    def test_reindex_products(self):
+        """ Rebuild the product id index from stored products """
+        Product.catalog.save(self.product)
+        Product.catalog.save(Product(name="Samsung", price=749))
+        Product.catalog.redis.delete('products')
+        self.assertEqual(Product.catalog.all(), [])
+        Product.catalog.reindex()
+        self.assertEqual(Product.catalog.ids(), [1, 2])
 
     def test_serialize_a_product(self):
         """ Test serialization of a product """
@@ -209,6 +246,121 @@ class TestProducts(unittest.TestCase):
         match = Product.catalog.query("name", "iPhone")
         self.assertEqual(2, len(match))
 
+    def test_query_product_by_text(self):
+        """ Query products by name and description substrings """
+        Product.catalog.save(Product(name="iPhone 8", price=649, description="Phone (new)"))
+        Product.catalog.save(Product(name="Galaxy", price=749, description="Android phone"))
+        match = Product.catalog.query("description", "PHONE")
+        self.assertEqual(len(match), 2)
+        match = Product.catalog.query("description", "(new)")
+        self.assertEqual([p.name for p in match], ["iPhone 8"])
+        match = Product.catalog.query("name", "e 8")
+        self.assertEqual([p.name for p in match], ["iPhone 8"])
+        match = Product.catalog.query("name", "a")
+        self.assertEqual([p.name for p in match], ["Galaxy"])
+        # n-grams of the old name must be dropped on update
+        product = Product.catalog.find(1)
+        product.set_name("Pixel")
+        Product.catalog.save(product)
+        self.assertEqual(Product.catalog.query("name", "iPhone"), [])
+        self.assertEqual(Product.catalog.query("name", "pix")[0].id, 1)
+        Product.catalog.delete(1)
+        self.assertEqual(Product.catalog.query("name", "pix"), [])
+
+    def test_search_with_many_filters(self):
+        """ Search products matching several filters at once """
+        Product.catalog.save(Product(name="iPhone 8", price=649, image_id="001"))
+        Product.catalog.save(Product(name="iPhone X", price=999, image_id="001"))
+        Product.catalog.save(Product(name="Pixel", price=649, image_id="001"))
+        Product.catalog.save(Product(name="iPhone SE", price=399, image_id="002"))
+        match = Product.catalog.search({"name": "iphone", "price_min": "500", "image_id": "001"})
+        self.assertEqual([p.name for p in match], ["iPhone 8", "iPhone X"])
+        match = Product.catalog.search({"name": "iphone", "price_min": 500, "price_max": 700})
+        self.assertEqual([p.name for p in match], ["iPhone 8"])
+        match = Product.catalog.search({"id": 3, "name": "iphone"})
+        self.assertEqual(match, [])
+        match = Product.catalog.search({"price_min": 700, "price_max": 500})
+        self.assertEqual(match, [])
+        self.assertEqual(len(Product.catalog.search({})), 4)
+
+    def test_search_with_cursor(self):
+        """ Search products one page at a time """
+        for name in ["iPhone", "Pixel", "iPad", "iMac"]:
+            Product.catalog.save(Product(name=name, price=649))
+        page = Product.catalog.search({}, limit=3)
+        self.assertEqual([p.id for p in page], [1, 2, 3])
+        page = Product.catalog.search({}, cursor=3, limit=3)
+        self.assertEqual([p.id for p in page], [4])
+        page = Product.catalog.search({"name": "i"}, limit=2)
+        self.assertEqual([p.name for p in page], ["iPhone", "Pixel"])
+        page = Product.catalog.search({"name": "i"}, cursor=2, limit=2)
+        self.assertEqual([p.name for p in page], ["iPad", "iMac"])
+
+    def test_search_sorted(self):
+        """ Search products in each sort order """
+        Product.catalog.save(Product(name="iPhone", price=649,
+                                     review_list=[Review(username="a", score=3)]))
+        Product.catalog.save(Product(name="Pixel", price=549,
+                                     review_list=[Review(username="b", score=5)]))
+        Product.catalog.save(Product(name="galaxy", price=749))
+        names = lambda products: [p.name for p in products]
+        self.assertEqual(names(Product.catalog.search({}, sort="price")),
+                         ["Pixel", "iPhone", "galaxy"])
+        self.assertEqual(names(Product.catalog.search({}, sort="price-", limit=2)),
+                         ["galaxy", "iPhone"])
+        self.assertEqual(names(Product.catalog.search({}, cursor=1, limit=1, sort="name")),
+                         ["iPhone"])
+        self.assertEqual(names(Product.catalog.search({}, sort="name-")),
+                         ["Pixel", "iPhone", "galaxy"])
+        self.assertEqual(names(Product.catalog.search({}, sort="review")),
+                         ["Pixel", "iPhone", "galaxy"])
+        self.assertEqual(names(Product.catalog.search({"price_min": 600}, sort="name")),
+                         ["galaxy", "iPhone"])
+        # renamed products move in the name order
+        product = Product.catalog.find(3)
+        product.set_name("Zune")
+        Product.catalog.save(product)
+        self.assertEqual(names(Product.catalog.search({}, sort="name")),
+                         ["iPhone", "Pixel", "Zune"])
+
+    def test_query_unknown_keyword(self):
+        """ Query products by an attribute that doesn't exist """
+        self.assertRaises(DataValidationError, Product.catalog.query, "color", "red")
+
+    def test_query_product_by_price(self):
+        """ Query products by exact price and price range """
+        Product.catalog.save(self.product)
+        Product.catalog.save(Product(name="Samsung", price=749))
+        Product.catalog.save(Product(name="Pixel", price=64))
+        match = Product.catalog.query("price", "649")
+        self.assertEqual([p.name for p in match], ["iPhone"])
+        match = Product.catalog.query("price_min", 100)
+        self.assertEqual([p.name for p in match], ["iPhone", "Samsung"])
+        match = Product.catalog.query("price_max", 649)
+        self.assertEqual([p.name for p in match], ["iPhone", "Pixel"])
+        self.assertRaises(DataValidationError, Product.catalog.query, "price", "cheap")
+
+    def test_query_product_by_image_id(self):
+        """ Query products by image id after an update and a delete """
+        Product.catalog.save(Product(name="iPhone", price=649, image_id="001"))
+        Product.catalog.save(Product(name="Samsung", price=749, image_id="001"))
+        Product.catalog.save(Product(name="Pixel", price=549, image_id="002"))
+        self.assertEqual(len(Product.catalog.query("image_id", "001")), 2)
+        product = Product.catalog.find(2)
+        product.set_image_id("002")
+        Product.catalog.save(product)
+        Product.catalog.delete(3)
+        match = Product.catalog.query("image_id", "001")
+        self.assertEqual([p.name for p in match], ["iPhone"])
+        match = Product.catalog.query("image_id", "002")
+        self.assertEqual([p.name for p in match], ["Samsung"])
+
+    def test_query_product_by_id(self):
+        """ Query a product by its id """
+        Product.catalog.save(self.product)
+        self.assertEqual(Product.catalog.query("id", "1")[0].name, "iPhone")
+        self.assertEqual(Product.catalog.query("id", "2"), [])
+
     def test_get_review_avg_score(self):
         """ Get average score for a list of reviews """
         watch_review_list = [Review(username="applefan", score="4", detail="OK"),
@@ -226,12 +378,508 @@ class TestProducts(unittest.TestCase):
         self.assertEquals(self.product.review_list, [])
         self.assertEqual(self.product.avg_score(), 0.0)
 
+    def test_review_aggregates(self):
+        """ Keep the review count and score sum of a product up to date """
+        self.product.set_review_list([Review(username="a", score=4)])
+        self.product.add_review(Review(username="b", score="1"))
+        self.assertEqual(self.product.review_count, 2)
+        self.assertEqual(self.product.review_score_sum, 5)
+        self.assertEqual(self.product.avg_score(), 2.5)
+        self.product.deserialize({"name": "iPhone", "price": 649, "review_list": []})
+        self.assertEqual(self.product.review_count, 0)
+        self.assertEqual(self.product.avg_score(), 0.0)
+
+    def test_add_review_to_catalog(self):
+        """ Add reviews to a product in the catalog """
+        Product.catalog.save(self.product)
+        Product.catalog.save(Product(name="Pixel", price=549,
+                                     review_list=[Review(username="a", score=3)]))
+        product = Product.catalog.add_review(1, Review(username="b", score=5))
+        self.assertEqual(product.review_count, 1)
+        Product.catalog.add_review(1, Review(username="c", score=2))
+        product = Product.catalog.find(1)
+        self.assertEqual([r.username for r in product.get_review_list()], ["b", "c"])
+        self.assertEqual(product.avg_score(), 3.5)
+        products = Product.catalog.search({}, sort="review")
+        self.assertEqual([p.name for p in products], ["iPhone", "Pixel"])
+        self.assertIsNone(Product.catalog.add_review(3, Review(username="d", score=1)))
+
+    def test_reviews_are_loaded_lazily(self):
+        """ Load the reviews of a product only when they are asked for """
+        self.product.set_review_list([Review(username="a", score=4),
+                                      Review(username="b", score=2)])
+        Product.catalog.save(self.product)
+        product = Product.catalog.find(1)
+        self.assertIsNone(product.review_list)
+        self.assertEqual(product.review_count, 2)
+        self.assertEqual(product.avg_score(), 3.0)
+        self.assertEqual([r.username for r in Product.catalog.reviews(1, 1, 1)], ["b"])
+        # saving a product whose reviews weren't loaded keeps them
+        product.set_price(599)
+        Product.catalog.save(product)
+        product = Product.catalog.find(1)
+        self.assertEqual(len(product.get_review_list()), 2)
+        products = Product.catalog.all()
+        Product.catalog.load_reviews(products)
+        self.assertEqual(products[0].serialize()["review_list"][0]["username"], "a")
+        Product.catalog.delete(1)
+        self.assertEqual(Product.catalog.reviews(1), [])
+
+    def test_save_and_delete_many(self):
+        """ Save and delete many products at once """
+        Product.catalog.save(self.product)
+        self.product.set_price(599)
+        pixel = Product(name="Pixel", price=549)
+        galaxy = Product(name="Galaxy", price=499)
+        Product.catalog.save_many([pixel, self.product, galaxy])
+        self.assertEqual((pixel.id, galaxy.id), (2, 3))
+        self.assertEqual(Product.catalog.next_index(), 4)
+        self.assertEqual([p.id for p in Product.catalog.search({"price_max": 599})], [1, 2, 3])
+        self.assertEqual(Product.catalog.delete_many([3, 5, 1, 3]), [3, 1])
+        self.assertEqual([p.name for p in Product.catalog.all()], ["Pixel"])
+        self.assertEqual(Product.catalog.query("name", "iphone"), [])
+
+    def test_iter_chunks(self):
+        """ Walk the catalog a chunk at a time """
+        for name in ["a", "b", "c", "d", "e"]:
+            Product.catalog.save(Product(name=name, price=1))
+        Product.catalog.delete(2)
+        with patch.object(Product.catalog, 'chunk_size', 2):
+            chunks = list(Product.catalog.iter_chunks(["name"]))
+        self.assertEqual([[p.name for p in chunk] for chunk in chunks], [["a", "c"], ["d", "e"]])
+
+    def test_find_with_fields(self):
+        """ Fetch only some of the fields of products """
+        self.product.set_review_list([Review(username="a", score=4)])
+        Product.catalog.save(self.product)
+        Product.catalog.save(Product(name="Pixel", price=549, description="Google phone"))
+        product = Product.catalog.find(1, ["name"])
+        self.assertEqual(product.name, "iPhone")
+        self.assertEqual(product.price, 0)
+        self.assertEqual(product.serialize(["id", "name"]), {"id": 1, "name": "iPhone"})
+        self.assertEqual(product.review_count, 1)
+        # fields that are filtered or sorted on are fetched as well
+        products = Product.catalog.search({"description": "google"}, sort="price", fields=["id"])
+        self.assertEqual([(p.id, p.price, p.description) for p in products],
+                         [(2, 549, "Google phone")])
+
+    def test_migrate_moves_reviews_out_of_products(self):
+        """ Move the reviews of products saved with their reviews inline """
+        data = {"id": 7, "name": "iPhone", "price": 649, "image_id": "",
+                "description": "", "review_list": [{"username": "a", "score": 5,
+                                                    "date": "", "detail": ""}]}
+        Product.catalog.redis.set(7, pickle.dumps(data))
+        product = Product.catalog.find(7)
+        self.assertEqual(product.avg_score(), 5.0)
+        self.assertEqual([review.username for review in Product.catalog.reviews(7)], ["a"])
+        self.assertEqual(Product.catalog.reviews(7, 1), [])
+        Product.catalog.migrate()
+        self.assertIsNone(Product.catalog.redis.get(7))
+        self.assertNotIn("review_list", Product.catalog.redis.hkeys("product:7"))
+        product = Product.catalog.find(7)
+        self.assertEqual(product.review_count, 1)
+        self.assertEqual(product.get_review_list()[0].username, "a")
+        Product.catalog.add_review(7, Review(username="b", score=3))
+        self.assertEqual(Product.catalog.find(7).avg_score(), 4.0)
+
+    def test_codecs(self):
+        """ Store reviews with each codec and read them back """
+        review = Review(username="a", score=4, detail=u"Tr\xe8s bien")
+        for codec in ["json", "msgpack"]:
+            Product.catalog.remove_all()
+            Product.catalog.use_codec(codec)
+            try:
+                self.product.set_review_list([review])
+                Product.catalog.save(self.product)
+                value = Product.catalog.redis.lindex("reviews:1", 0)
+                self.assertEqual(value[:2], b"\x01" + Product.catalog.codec.tag)
+                product = Product.catalog.find(self.product.id)
+                self.assertEqual(product.name, "iPhone")
+                self.assertEqual(product.get_review_list()[0].detail, u"Tr\xe8s bien")
+            finally:
+                Product.catalog.use_codec("msgpack")
+        self.assertRaises(ValueError, Product.catalog.use_codec, "pickle")
+
+    def test_migrate_codec(self):
+        """ Migrate products and reviews stored with pickle and another codec """
+        data = {"id": 1, "name": "iPhone", "price": 649, "image_id": "", "description": ""}
+        review = {"username": "a", "score": 5, "date": "", "detail": ""}
+        Product.catalog.redis.set(1, pickle.dumps(data))
+        Product.catalog.redis.rpush("reviews:1", pickle.dumps(review))
+        Product.catalog.use_codec("json")
+        try:
+            Product.catalog.save(Product(name="Pixel", price=549, id=2,
+                                         review_list=[Review(username="b", score=4)]))
+        finally:
+            Product.catalog.use_codec("msgpack")
+        self.assertEqual(Product.catalog.migrate(), 3)
+        self.assertEqual(Product.catalog.migrate(), 0)
+        for key in ["reviews:1", "reviews:2"]:
+            self.assertEqual(Product.catalog.redis.lindex(key, 0)[:2], b"\x01m")
+        self.assertIsNone(Product.catalog.redis.get(1))
+        product = Product.catalog.find(1)
+        self.assertEqual(product.name, "iPhone")
+        self.assertEqual(product.get_review_list()[0].username, "a")
+
+    def test_products_are_stored_as_hashes(self):
+        """ Store each product as a hash and only write changed fields """
+        Product.catalog.save(self.product)
+        stored = Product.catalog.redis.hgetall("product:1")
+        self.assertEqual(stored[b"name"], b"iPhone")
+        self.assertEqual(stored[b"price"], b"649")
+        self.product.set_price(599)
+        with patch('redis.client.Pipeline.hset') as hset:
+            Product.catalog.save(self.product)
+        hset.assert_any_call("product:1", mapping={"price": 599})
+        Product.catalog.save(self.product)
+        self.assertEqual(Product.catalog.find(1).price, 599)
+        data = list(Product.catalog.fetch([1], fields=["name"]))
+        self.assertEqual(data, [{"id": 1, "name": "iPhone", "review_count": 0,
+                                 "review_score_sum": 0}])
+
+    def test_read_products_stored_as_values(self):
+        """ Read, update and delete a product stored as a single value """
+        data = {"id": 1, "name": "iPhone", "price": 649, "image_id": "001", "description": ""}
+        Product.catalog.redis.set(1, pickle.dumps(data))
+        Product.catalog.reindex()
+        self.assertTrue(Product.catalog.exists(1))
+        self.assertEqual(Product.catalog.query("image_id", "001")[0].name, "iPhone")
+        self.assertEqual(Product.catalog.add_review(1, Review(username="a", score=4)).review_count, 1)
+        product = Product.catalog.find(1)
+        product.set_price(599)
+        Product.catalog.save(product)
+        self.assertIsNone(Product.catalog.redis.get(1))
+        self.assertEqual(Product.catalog.find(1).price, 599)
+        Product.catalog.delete(1)
+        self.assertFalse(Product.catalog.exists(1))
+
+    def test_index_stored_products_on_init(self):
+        """ Index products saved before the indexes existed when connecting """
+        data = {"id": 1, "name": "iPhone", "price": 649, "image_id": "001", "description": ""}
+        Product.catalog.redis.set(1, pickle.dumps(data))
+        Product.catalog.init_db()
+        self.assertEqual(Product.catalog.all(), [])
+        Product.catalog.redis.delete("catalog:indexed")
+        version = Product.catalog.version()[0]
+        Product.catalog.init_db()
+        self.assertEqual([product.name for product in Product.catalog.all()], ["iPhone"])
+        self.assertNotEqual(Product.catalog.version()[0], version)
+        # a catalog emptied since isn't indexed again on every start
+        Product.catalog.delete(1)
+        with patch.object(Product.catalog, 'reindex') as reindex:
+            Product.catalog.init_db()
+            self.assertFalse(reindex.called)
+
+    def test_reindex_keeps_products_saved_meanwhile(self):
+        """ Only add index entries, so products saved during a reindex stay listed """
+        Product.catalog.save(self.product)
+        fetch = Product.catalog.fetch
+
+        def fetch_and_save(ids, fields=None):
+            """ Saves a product behind the back of the reindex """
+            if not Product.catalog.exists(2):
+                Product.catalog.save(Product(name="Pixel", price=549))
+            return fetch(ids, fields)
+
+        with patch.object(Product.catalog, 'fetch', side_effect=fetch_and_save):
+            Product.catalog.reindex()
+        self.assertEqual(Product.catalog.ids(), [1, 2])
+        self.assertEqual(Product.catalog.query("name", "pixel")[0].id, 2)
+
+    def test_review_products_stored_with_inline_reviews(self):
+        """ Keep the reviews of products stored as values with their reviews inline """
+        data = {"id": 3, "name": "iPhone", "price": 649, "image_id": "", "description": "",
+                "review_list": []}
+        Product.catalog.redis.set(3, pickle.dumps(data))
+        Product.catalog.add_review(3, Review(username="a", score=4))
+        self.assertIsNone(Product.catalog.redis.get(3))
+        product = Product.catalog.find(3)
+        self.assertEqual([review.username for review in product.get_review_list()], ["a"])
+        product = Product.catalog.find(3)
+        product.set_price(599)
+        Product.catalog.save(product)
+        Product.catalog.migrate()
+        product = Product.catalog.find(3)
+        self.assertEqual((product.price, product.review_count, product.avg_score()), (599, 1, 4.0))
+        self.assertEqual(Product.catalog.search({}, sort="review")[0].id, 3)
+        self.assertEqual(Product.catalog.redis.zscore("index:sort:review", 3), 4.0)
+        # reviews listed next to a value by an earlier version are read too
+        data["review_list"] = [{"username": "b", "score": 2, "date": "", "detail": ""}]
+        Product.catalog.redis.set(4, pickle.dumps(dict(data, id=4)))
+        Product.catalog.redis.rpush("reviews:4", Product.catalog._encode(
+            {"username": "c", "score": 4, "date": "", "detail": ""}))
+        self.assertEqual([review.username for review in Product.catalog.find(4).get_review_list()],
+                         ["b", "c"])
+        Product.catalog.migrate()
+        self.assertEqual(Product.catalog.find(4).avg_score(), 3.0)
+
     @patch.dict(os.environ, {'VCAP_SERVICES': VCAP_SERVICES})
     def test_vcap_services(self):
         """ Test if VCAP_SERVICES works """
         Product.catalog.init_db()
         self.assertIsNotNone(Product.catalog.redis)
 
+    def test_score_min_filter(self):
+        """ Find products with a minimum average review score """
+        Product.catalog.save(self.product)
+        Product.catalog.save(Product(name="Pixel", price=549))
+        Product.catalog.add_review(1, Review(username="a", score=5))
+        Product.catalog.add_review(1, Review(username="b", score=2))
+        self.assertEqual([p.id for p in Product.catalog.search({"score_min": "3.5"})], [1])
+        self.assertEqual([p.id for p in Product.catalog.search({"score_min": "4"})], [])
+        self.assertEqual([p.id for p in Product.catalog.search({"score_min": "0", "name": "p"})],
+                         [1, 2])
+        self.assertRaises(DataValidationError, Product.catalog.search, {"score_min": "high"})
+
+    def test_snapshot_search(self):
+        """ Answer filtered searches from the columnar snapshot """
+        for name, price in [("iPhone", 649), ("Pixel", 549), ("Galaxy", 549),
+                            ("Moto", 199), ("iPad", 329)]:
+            Product.catalog.save(Product(name=name, price=price))
+        for id, score in [(1, 4), (2, 5), (3, 4), (4, 2)]:
+            Product.catalog.add_review(id, Review(username="a", score=score))
+        queries = [({"price_min": "300", "score_min": "3"}, None, None, "price"),
+                   ({"price_max": "600"}, 1, 2, "price-"),
+                   ({"name": "I"}, None, None, "name-"),
+                   ({"score_min": "0"}, None, None, "review"),
+                   ({"name": "p", "id": "5"}, None, None, None),
+                   ({"price": "549"}, 2, None, None)]
+
+        def search_all():
+            """ Returns the ids of the products of each query """
+            return [[p.id for p in Product.catalog.search(filters, cursor, limit, sort)]
+                    for filters, cursor, limit, sort in queries]
+
+        expected = search_all()
+        try:
+            Product.catalog.use_snapshot(True)
+        except ValueError:
+            self.skipTest('numpy is not installed')
+        try:
+            with patch.object(Product.catalog, '_candidates') as candidates:
+                self.assertEqual(search_all(), expected)
+                self.assertFalse(candidates.called)
+            # a change is read back once it is received
+            product = Product.catalog.find(4)
+            product.set_price(599)
+            Product.catalog.save(product)
+            Product.catalog.delete(2)
+            with patch.object(Product.catalog.snapshot, 'search', return_value=None):
+                expected = search_all()
+            for _ in range(50):
+                if Product.catalog.snapshot.refresh():
+                    break
+                time.sleep(0.02)
+            with patch.object(Product.catalog, '_candidates') as candidates:
+                self.assertEqual(search_all(), expected)
+                self.assertFalse(candidates.called)
+            # searches the snapshot doesn't hold are left to Redis
+            self.assertIsNone(Product.catalog.snapshot.search({"image_id": ""}, None, None, None))
+            # changes that pile up without searches are dropped for a rebuild
+            snapshot = Product.catalog.snapshot
+            with patch.object(models.CatalogSnapshot, 'MAX_CHANGES', 2):
+                for version in range(100, 105):
+                    snapshot.changed(version, [1])
+                self.assertLessEqual(len(snapshot.changes), 2)
+                self.assertTrue(snapshot.rebuild)
+            Product.catalog.delete(1)
+            for _ in range(50):
+                if snapshot.refresh():
+                    break
+                time.sleep(0.02)
+            self.assertFalse(snapshot.rebuild)
+            self.assertNotIn(1, snapshot.columns[0])
+        finally:
+            Product.catalog.use_snapshot(False)
+
+    def test_compact_products(self):
+        """ Keep products and reviews without a __dict__ """
+        review = Review(username="a", score=4)
+        self.assertFalse(hasattr(self.product, '__dict__'))
+        self.assertFalse(hasattr(review, '__dict__'))
+        self.assertRaises(AttributeError, setattr, self.product, 'color', 'red')
+        self.assertRaises(DataValidationError, review.deserialize, {"color": "red"})
+
+    def test_schema_validator(self):
+        """ Validate products with the compiled schema """
+        validator = Product.catalog.validator
+        self.assertTrue(validator.validate({"name": u"iPhone", "price": 649L, "review_list": []}))
+        self.assertFalse(validator.validate({"name": "iPhone"}))
+        self.assertFalse(validator.validate({"name": "iPhone", "price": "649"}))
+        self.assertFalse(validator.validate({"name": None, "price": 649}))
+        self.assertFalse(validator.validate({"name": "iPhone", "price": 649, "color": "red"}))
+        self.assertFalse(validator.validate(["iPhone", 649]))
+        self.assertRaises(ValueError, SchemaValidator, {"name": {"type": "string", "regex": "i.*"}})
+        # data read back from the catalog isn't validated again
+        product = Product().deserialize({"id": 2, "price": 649}, validate=False)
+        self.assertEqual((product.id, product.name, product.price), (2, "", 649))
+
+    def test_save_with_versions(self):
+        """ Only save a product stored at one of the expected versions """
+        Product.catalog.save(self.product)
+        first = self.product.version
+        self.assertIsNotNone(first)
+        self.product.set_price(599)
+        Product.catalog.save(self.product, [first])
+        self.assertNotEqual(self.product.version, first)
+        self.product.set_price(549)
+        self.assertRaises(VersionConflictError, Product.catalog.save, self.product, [first])
+        self.assertEqual(Product.catalog.find(1).price, 599)
+        self.assertEqual(Product.catalog.product_version(1)[0], self.product.version)
+        self.assertRaises(VersionConflictError, Product.catalog.add_review,
+                          1, Review(username="a", score=5), [first])
+        product = Product.catalog.add_review(1, Review(username="a", score=5), [self.product.version])
+        self.assertEqual(product.review_count, 1)
+        self.assertEqual(Product.catalog.product_version(1)[0], product.version)
+
+    def test_save_many_round_trips(self):
+        """ Save a batch in a few round trips however many products it has """
+        send = Connection.send_packed_command
+        sent = []
+
+        def count_and_send(connection, command, *args, **kwargs):
+            """ Counts the writes to the socket """
+            sent.append(command)
+            return send(connection, command, *args, **kwargs)
+
+        products = [Product(name="Product {0}".format(i), price=i) for i in range(200)]
+        with patch.object(Connection, 'send_packed_command', count_and_send):
+            Product.catalog.save_many(products)
+            created = len(sent)
+            for product in products:
+                product.set_price(product.price + 1)
+            Product.catalog.save_many(products)
+        self.assertLessEqual(created, 5)
+        self.assertLessEqual(len(sent) - created, 6)
+        self.assertEqual(Product.catalog.find(200).price, 200)
+
+    def test_save_retries_on_concurrent_change(self):
+        """ Retry a save when another client changes the product meanwhile """
+        Product.catalog.save(self.product)
+        read_many = Product.catalog._read_many
+        calls = []
+
+        def read_and_change(ids, client=None):
+            """ Renames the product behind the back of the first save """
+            if not calls:
+                Product.catalog.redis.hset("product:1", "name", "Pixel")
+            calls.append(ids)
+            return read_many(ids, client)
+
+        with patch.object(Product.catalog, '_read_many', side_effect=read_and_change):
+            self.product.set_price(599)
+            Product.catalog.save(self.product)
+        self.assertEqual(len(calls), 2)
+        # the index entries of the concurrent name are the ones removed
+        self.assertEqual(Product.catalog.query("name", "pixel"), [])
+        self.assertEqual(Product.catalog.query("name", "iphone")[0].price, 599)
+
+    def test_catalog_version(self):
+        """ Bump the catalog version on every change """
+        Product.catalog.save(self.product)
+        version, modified = Product.catalog.version()
+        self.assertGreater(modified, 0)
+        Product.catalog.find(1)
+        self.assertEqual(Product.catalog.version()[0], version)
+        Product.catalog.delete(1)
+        self.assertNotEqual(Product.catalog.version()[0], version)
+        Product.catalog.remove_all()
+        Product.catalog.save(self.product)
+        self.assertNotEqual(Product.catalog.version()[0], version)
+
+    def test_find_cache(self):
+        """ Serve finds from the cache until another instance changes the product """
+        Product.catalog.save(self.product)
+        Product.catalog.use_cache(1, 60)
+        try:
+            self.assertEqual(Product.catalog.find(1).name, "iPhone")
+            self.assertEqual(Product.catalog.find(1).name, "iPhone")
+            # a change made by another instance is only seen once it is published
+            Product.catalog.redis.hset("product:1", "name", "iPhone X")
+            self.assertEqual(Product.catalog.find(1).name, "iPhone")
+            Product.catalog.redis.publish(models.INVALIDATE_CHANNEL, "other:0:1")
+            for _ in range(50):
+                if not Product.catalog.cache.entries:
+                    break
+                time.sleep(0.02)
+            self.assertEqual(Product.catalog.find(1).name, "iPhone X")
+            Product.catalog.add_review(1, Review(username="a", score=5))
+            self.assertEqual(Product.catalog.find(1).review_count, 1)
+            Product.catalog.save(Product(name="Pixel", price=549))
+            Product.catalog.find(2)
+            stats = Product.catalog.cache_stats()
+            self.assertEqual((stats['size'], stats['max_size']), (1, 1))
+            self.assertGreaterEqual(stats['hits'], 2)
+            self.assertGreaterEqual(stats['evictions'], 1)
+            Product.catalog.delete(2)
+            self.assertIsNone(Product.catalog.find(2))
+        finally:
+            Product.catalog.use_cache(0, 0)
+        self.assertIsNone(Product.catalog.cache_stats())
+
+    def test_changes(self):
+        """ Append every change to the change stream and resume reading after an offset """
+        changes = Product.catalog.changes()
+        self.assertEqual([event['op'] for _, event in changes], ['clear'])
+        since = changes[-1][0]
+        Product.catalog.save(self.product)
+        self.product.set_price(549)
+        Product.catalog.save(self.product)
+        Product.catalog.add_review(1, Review(username="a", score=5))
+        Product.catalog.delete(1)
+        changes = Product.catalog.changes(since)
+        self.assertEqual([(event['op'], event['id']) for _, event in changes],
+                         [('create', 1), ('update', 1), ('review', 1), ('delete', 1)])
+        self.assertEqual(changes[1][1]['fields'], ['price', 'review_list'])
+        self.assertEqual(changes[2][1]['fields'], ['review_list'])
+        self.assertEqual(changes[1][1]['version'], Product.catalog.redis.xrange(
+            models.CHANGES_STREAM, changes[1][0], changes[1][0])[0][1][b'version'].decode('utf-8'))
+        self.assertEqual(changes[-1][1]['catalog_version'], Product.catalog.version()[0])
+        # a consumer picks up where it left off
+        self.assertEqual(Product.catalog.changes(changes[1][0], count=1), changes[2:3])
+        self.assertEqual(Product.catalog.changes(changes[-1][0]), [])
+
+    def test_changes_block_longer_than_socket_timeout(self):
+        """ Wait for changes for longer than the socket timeout """
+        since = Product.catalog.changes()[-1][0]
+        redis = Redis(host='127.0.0.1', port=6379, socket_timeout=0.3)
+        with patch.object(Product.catalog, 'redis', redis):
+            start = time.time()
+            self.assertEqual(Product.catalog.changes(since, block=800), [])
+            self.assertGreaterEqual(time.time() - start, 0.8)
+            timer = threading.Timer(0.5, Product.catalog.save, [self.product])
+            timer.start()
+            changes = Product.catalog.changes(since, block=0)
+            timer.join()
+        self.assertEqual([event['op'] for _, event in changes], ['create'])
+
+    @patch.dict(os.environ, {'VCAP_SERVICES': VCAP_SERVICES})
+    @patch.object(Product.catalog, 'pool_options', {'max_connections': 1, 'timeout': 1})
+    def test_save_with_one_connection(self):
+        """ Save products while holding a single connection of the pool """
+        Product.catalog.init_db()
+        # the cache invalidations don't take the only connection
+        Product.catalog.use_cache(10, 60)
+        try:
+            Product.catalog.save(self.product)
+            self.product.set_price(599)
+            Product.catalog.save(self.product, [Product.catalog.product_version(1)[0]])
+            self.assertEqual(Product.catalog.find(1).price, 599)
+        finally:
+            Product.catalog.use_cache(0, 0)
+
+    @patch.dict(os.environ, {'VCAP_SERVICES': VCAP_SERVICES})
+    @patch.object(Product.catalog, 'pool_options', {'max_connections': 3, 'timeout': 1})
+    def test_connection_pool(self):
+        """ Connect through a connection pool and report its use """
+        Product.catalog.init_db()
+        self.assertEqual(Product.catalog.pool_stats(),
+                         {'max_connections': 3, 'created': 1, 'in_use': 0, 'idle': 1})
+        Product.catalog.save(self.product)
+        self.assertEqual(Product.catalog.pool_stats()['in_use'], 0)
+        Product.catalog.redis = None
+        self.assertIsNone(Product.catalog.pool_stats())
+
     @patch('redis.Redis.ping')
     def test_redis_connection_error(self, ping_error_mock):
         """ Test a Bad Redis connection """
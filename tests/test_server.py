@@ -23,6 +23,8 @@ Test cases can be run with:
 import logging
 import unittest
 import json
+import pickle
+from mock import patch
 from flask_api import status    # HTTP Status Codes
 from app.models import Product, Review
 from app import server
@@ -54,6 +56,19 @@ class TestProductServer(unittest.TestCase):
         """ Runs after each test """
         server.Product.catalog.remove_all()
 
+    def test_stats(self):
+        """ Report the use of the Redis connection pool and the cache """
+        self.app.get('/products/1')
+        self.app.get('/products/1', query_string='include_reviews=false')
+        resp = self.app.get('/stats')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['redis_pool']['max_connections'],
+                         server.app.config['REDIS_MAX_CONNECTIONS'])
+        # the cache invalidations are received on a connection of their own
+        self.assertEqual(data['redis_pool']['in_use'], 0)
+        self.assertEqual((data['cache']['hits'], data['cache']['misses']), (1, 1))
+
     def test_index(self):
         """ Test the Home Page"""
         resp = self.app.get('/')
@@ -186,6 +201,218 @@ class TestProductServer(unittest.TestCase):
         self.assertEqual(new_json['review_list'][-1]
                          ['username'], 'Grumpy Grumperson')
 
+    def test_update_product_keeps_reviews(self):
+        """ Update a product without losing its reviews """
+        new_review = {"username": "Happy Camper", "score": 5}
+        resp = self.app.put("products/1/review", data=json.dumps(new_review),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.dumps({'name': 'iPhone 8 Plus', 'price': 749})
+        resp = self.app.put('/products/1', data=data, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        new_json = json.loads(resp.data)
+        self.assertEqual(new_json['review_list'][0]['username'], 'Happy Camper')
+        resp = self.app.get('/products', query_string='name=plus')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data[0]['review_list']), 1)
+
+    def test_list_product_reviews_by_page(self):
+        """ Get the reviews of a product one page at a time """
+        for username in ['alice', 'bob', 'carol']:
+            review = json.dumps({"username": username, "score": 4})
+            self.app.put("products/1/review", data=review, content_type='application/json')
+        resp = self.app.get('/products/1/reviews', query_string='limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([r['username'] for r in data], ['alice', 'bob'])
+        self.assertIn('cursor=2', resp.headers.get('Link'))
+        resp = self.app.get('/products/1/reviews', query_string='limit=2&cursor=2')
+        data = json.loads(resp.data)
+        self.assertEqual([r['username'] for r in data], ['carol'])
+        self.assertIsNone(resp.headers.get('Link'))
+        resp = self.app.get('/products/5/reviews')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_products_without_reviews(self):
+        """ Get products with a review summary instead of their reviews """
+        review = json.dumps({"username": "alice", "score": 4})
+        self.app.put("products/1/review", data=review, content_type='application/json')
+        resp = self.app.get('/products', query_string='include_reviews=false')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertNotIn('review_list', data[0])
+        self.assertEqual(data[0]['review_count'], 1)
+        self.assertEqual(data[0]['avg_score'], 4.0)
+        resp = self.app.get('/products/1', query_string='include_reviews=false')
+        data = json.loads(resp.data)
+        self.assertNotIn('review_list', data)
+        self.assertEqual(data['review_count'], 1)
+
+    def test_get_products_with_fields(self):
+        """ Get only some of the fields of products """
+        review = json.dumps({"username": "alice", "score": 4})
+        self.app.put("products/1/review", data=review, content_type='application/json')
+        resp = self.app.get('/products', query_string='fields=id,name,avg_score')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data[0], {"id": 1, "name": "iPhone 8", "avg_score": 4.0})
+        resp = self.app.get('/products/1', query_string='fields=price,review_list')
+        data = json.loads(resp.data)
+        self.assertEqual(sorted(data.keys()), ['price', 'review_list'])
+        self.assertEqual(data['review_list'][0]['username'], 'alice')
+        resp = self.app.get('/products', query_string='fields=id,password')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_products_batch(self):
+        """ Create and update many products at once """
+        review = json.dumps({"username": "alice", "score": 4})
+        self.app.put("products/1/review", data=review, content_type='application/json')
+        update = json.dumps({"name": "iPhone 8", "price": 649, "description": "Red"})
+        self.app.put("products/1", data=update, content_type='application/json')
+        products = [{"name": "Pixel", "price": "549"},
+                    {"name": "Galaxy"},
+                    {"id": 1, "name": "iPhone 8", "price": 599},
+                    {"id": 9, "name": "Nokia", "price": 99}]
+        resp = self.app.post('/products/batch', data=json.dumps(products),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([result['status'] for result in data], [201, 400, 200, 404])
+        self.assertEqual(data[0]['id'], 3)
+        resp = self.app.get('/products/1')
+        data = json.loads(resp.data)
+        self.assertEqual(data['price'], 599)
+        self.assertEqual(data['description'], "Red")
+        self.assertEqual(len(data['review_list']), 1)
+        resp = self.app.post('/products/batch', data=json.dumps({"name": "Pixel"}),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_delete_products_batch(self):
+        """ Delete many products at once """
+        resp = self.app.delete('/products/batch', data=json.dumps([2, 7]),
+                               content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), [{"id": 2, "status": 204},
+                                                 {"id": 7, "status": 404}])
+        self.assertEqual(self.get_product_count(), 1)
+        resp = self.app.delete('/products/batch', data=json.dumps(["2"]),
+                               content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @patch.dict(server.app.config, {'CATALOG_CHUNK_SIZE': 2})
+    def test_import_products(self):
+        """ Import a stream of newline delimited JSON products """
+        lines = ['{"name": "Pixel", "price": 549}',
+                 '{"name": "Galaxy", "price": 499',
+                 '',
+                 '{"id": 1, "name": "iPhone X", "price": 999}',
+                 '{"name": "Nokia"}',
+                 '{"name": "Moto", "price": 199}']
+        resp = self.app.post('/products/import', data='\n'.join(lines),
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        reports = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual([report.get('line') for report in reports if 'status' in report], [2, 5])
+        self.assertEqual(reports[-1], {"done": True, "imported": 3, "errors": 2})
+        # a progress report for each of the three chunks and the summary
+        self.assertEqual(len([report for report in reports if 'status' not in report]), 4)
+        self.assertEqual(self.get_product_count(), 4)
+        resp = self.app.get('/products/1')
+        self.assertEqual(json.loads(resp.data)['name'], 'iPhone X')
+
+    def test_export_products(self):
+        """ Export the catalog as newline delimited JSON """
+        resp = self.app.get('/products/export', query_string='fields=id,name')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in resp.data.splitlines()],
+                         [{"id": 1, "name": "iPhone 8"}, {"id": 2, "name": "MacBook Pro"}])
+        resp = self.app.get('/products', headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        data = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual([product['review_list'] for product in data], [[], []])
+        resp = self.app.get('/products', query_string='name=mac',
+                            headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(len(resp.data.splitlines()), 1)
+
+    def test_cached_responses(self):
+        """ Cache rendered responses and answer conditional requests """
+        with patch.object(Product.catalog, 'search', wraps=Product.catalog.search) as search:
+            resp = self.app.get('/products', query_string='sort=price&limit=5')
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            etag = resp.headers['ETag']
+            self.assertIsNotNone(resp.headers.get('Last-Modified'))
+            resp = self.app.get('/products', query_string='limit=5&sort=price')
+            self.assertEqual(resp.headers['ETag'], etag)
+            self.assertEqual(len(json.loads(resp.data)), 2)
+            self.assertEqual(search.call_count, 1)
+        resp = self.app.get('/products', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.data, '')
+        server.data_load({"name": "Pixel", "price": 549})
+        resp = self.app.get('/products/1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        resp = self.app.get('/products/5', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cached_responses_are_replaced(self):
+        """ Keep only the latest version of a cached response within the byte limit """
+        server.response_cache.drop()
+        for name in ["Pixel", "Galaxy", "Nokia"]:
+            self.assertEqual(self.app.get('/products').status_code, status.HTTP_200_OK)
+            server.data_load({"name": name, "price": 549})
+        resp = self.app.get('/products')
+        self.assertEqual(len(json.loads(resp.data)), 5)
+        self.assertEqual(server.response_cache.stats()['size'], 1)
+        self.assertEqual(server.response_cache.stats()['bytes'], len(resp.data))
+        with patch.object(server.response_cache, 'max_bytes', len(resp.data) - 1):
+            server.data_load({"name": "Moto", "price": 199})
+            self.app.get('/products')
+            self.assertEqual(server.response_cache.stats()['size'], 0)
+
+    def test_update_product_if_match(self):
+        """ Only update a product that wasn't changed since it was read """
+        resp = self.app.get('/products/1')
+        etag = resp.headers['ETag']
+        update = json.dumps({"name": "iPhone 8", "price": 599})
+        resp = self.app.put('/products/1', data=update, content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        resp = self.app.put('/products/1', data=update, content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        review = json.dumps({"username": "alice", "score": 4})
+        resp = self.app.put('/products/1/review', data=review, content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        etag = self.app.get('/products/1').headers['ETag']
+        resp = self.app.put('/products/1/review', data=review, content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers['ETag'], self.app.get('/products/1').headers['ETag'])
+
+    def test_update_unversioned_product_if_match(self):
+        """ Update a product stored before products had versions with its ETag """
+        data = {"id": 9, "name": "Nokia", "price": 99, "image_id": "", "description": ""}
+        Product.catalog.redis.set(9, pickle.dumps(data))
+        etag = self.app.get('/products/9').headers['ETag']
+        review = json.dumps({"username": "alice", "score": 4})
+        resp = self.app.put('/products/9/review', data=review, content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        Product.catalog.redis.hdel('product:9', 'version')
+        etag = self.app.get('/products/9').headers['ETag']
+        update = json.dumps({"name": "Nokia 3310", "price": 99})
+        resp = self.app.put('/products/9', data=update, content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.put('/products/9', data=update, content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
     def test_add_nonexistent_product_review(self):
         """ Add review to an nonexistent product """
         new_review = {"username": "Grumpy Grumperson",
@@ -245,6 +472,61 @@ class TestProductServer(unittest.TestCase):
         query_item = data[0]
         self.assertEqual(query_item['name'], 'iPhone 8')
 
+    def test_query_price_range(self):
+        """ Get products within a price range """
+        resp = self.app.get('/products', query_string='price_min=700&price_max=2000')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['name'], 'MacBook Pro')
+        resp = self.app.get('/products', query_string='price=64')
+        self.assertEqual(json.loads(resp.data), [])
+
+    def test_query_many_keywords(self):
+        """ Get products matching several keywords """
+        resp = self.app.get('/products', query_string='name=o&price_max=1000&sort=price')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['name'], 'iPhone 8')
+
+    def test_query_bad_price(self):
+        """ Query products with a price that is not a number """
+        resp = self.app.get('/products', query_string='price=cheap')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_products_by_page(self):
+        """ Get the list of products one page at a time """
+        server.data_load({"name": "Pixel", "price": 549})
+        resp = self.app.get('/products', query_string='limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([p['name'] for p in data], ['iPhone 8', 'MacBook Pro'])
+        link = resp.headers.get('Link')
+        self.assertIn('cursor=2', link)
+        self.assertIn('rel="next"', link)
+        resp = self.app.get('/products', query_string='limit=2&cursor=2')
+        data = json.loads(resp.data)
+        self.assertEqual([p['name'] for p in data], ['Pixel'])
+        self.assertIsNone(resp.headers.get('Link'))
+
+    def test_list_sorted_products_by_page(self):
+        """ Get the list of products sorted by price one page at a time """
+        server.data_load({"name": "Pixel", "price": 549})
+        resp = self.app.get('/products', query_string='sort=price-&limit=2')
+        data = json.loads(resp.data)
+        self.assertEqual([p['name'] for p in data], ['MacBook Pro', 'iPhone 8'])
+        resp = self.app.get('/products', query_string='sort=price-&limit=2&cursor=2')
+        data = json.loads(resp.data)
+        self.assertEqual([p['name'] for p in data], ['Pixel'])
+
+    def test_list_products_bad_limit(self):
+        """ Get the list of products with a bad page size """
+        resp = self.app.get('/products', query_string='limit=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/products', query_string='limit=ten')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_method_not_allowed(self):
         """ Call a Method thats not Allowed """
         resp = self.app.post('/products/0')